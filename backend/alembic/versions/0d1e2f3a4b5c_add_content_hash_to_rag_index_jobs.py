@@ -0,0 +1,25 @@
+"""add content_hash to rag_index_jobs
+
+Revision ID: 0d1e2f3a4b5c
+Revises: 9c0d1e2f3a4b
+Create Date: 2026-10-17 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0d1e2f3a4b5c'
+down_revision = '9c0d1e2f3a4b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('rag_index_jobs', sa.Column('content_hash', sa.String(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('rag_index_jobs') as batch_op:
+        batch_op.drop_column('content_hash')
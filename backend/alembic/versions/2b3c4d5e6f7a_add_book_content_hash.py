@@ -0,0 +1,52 @@
+"""add content_hash to books
+
+Revision ID: 2b3c4d5e6f7a
+Revises: 1a2b3c4d5e6f
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+import hashlib
+import os
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2b3c4d5e6f7a'
+down_revision = '1a2b3c4d5e6f'
+branch_labels = None
+depends_on = None
+
+
+def _file_sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def upgrade():
+    op.add_column('books', sa.Column('content_hash', sa.String(), nullable=True))
+
+    # Calcular el hash de los libros ya existentes que sigan en disco
+    bind = op.get_bind()
+    books = sa.table('books', sa.column('id', sa.Integer), sa.column('file_path', sa.String), sa.column('content_hash', sa.String))
+    seen = set()
+    for book_id, file_path in bind.execute(sa.select(books.c.id, books.c.file_path)).fetchall():
+        if not file_path or not os.path.exists(file_path):
+            continue
+        content_hash = _file_sha256(file_path)
+        if content_hash in seen:
+            continue # Duplicado ya existente: se deja sin hash para no romper el índice único
+        seen.add(content_hash)
+        bind.execute(books.update().where(books.c.id == book_id).values(content_hash=content_hash))
+
+    op.create_index(op.f('ix_books_content_hash'), 'books', ['content_hash'], unique=True)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_books_content_hash'), table_name='books')
+    with op.batch_alter_table('books') as batch_op:
+        batch_op.drop_column('content_hash')
@@ -0,0 +1,42 @@
+"""create books_fts full-text index
+
+Revision ID: 4d5e6f7a8b9c
+Revises: 3c4d5e6f7a8b
+Create Date: 2026-10-17 13:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '4d5e6f7a8b9c'
+down_revision = '3c4d5e6f7a8b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+        title, author, category,
+        content='books', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""")
+    op.execute("""CREATE TRIGGER IF NOT EXISTS books_fts_ai AFTER INSERT ON books BEGIN
+        INSERT INTO books_fts(rowid, title, author, category) VALUES (new.id, new.title, new.author, new.category);
+    END""")
+    op.execute("""CREATE TRIGGER IF NOT EXISTS books_fts_ad AFTER DELETE ON books BEGIN
+        INSERT INTO books_fts(books_fts, rowid, title, author, category) VALUES ('delete', old.id, old.title, old.author, old.category);
+    END""")
+    op.execute("""CREATE TRIGGER IF NOT EXISTS books_fts_au AFTER UPDATE ON books BEGIN
+        INSERT INTO books_fts(books_fts, rowid, title, author, category) VALUES ('delete', old.id, old.title, old.author, old.category);
+        INSERT INTO books_fts(rowid, title, author, category) VALUES (new.id, new.title, new.author, new.category);
+    END""")
+    # Indexar los libros ya existentes
+    op.execute("INSERT INTO books_fts(books_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    op.execute("DROP TRIGGER IF EXISTS books_fts_au")
+    op.execute("DROP TRIGGER IF EXISTS books_fts_ad")
+    op.execute("DROP TRIGGER IF EXISTS books_fts_ai")
+    op.execute("DROP TABLE IF EXISTS books_fts")
@@ -0,0 +1,33 @@
+"""create category_counts aggregates table
+
+Revision ID: 5e6f7a8b9c0d
+Revises: 4d5e6f7a8b9c
+Create Date: 2026-10-17 13:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e6f7a8b9c0d'
+down_revision = '4d5e6f7a8b9c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('category_counts',
+    sa.Column('category', sa.String(), nullable=False),
+    sa.Column('book_count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('category')
+    )
+    # Inicializar los agregados con los libros ya existentes
+    op.execute(
+        "INSERT INTO category_counts (category, book_count) "
+        "SELECT category, COUNT(*) FROM books WHERE category IS NOT NULL GROUP BY category"
+    )
+
+
+def downgrade():
+    op.drop_table('category_counts')
@@ -0,0 +1,32 @@
+"""create library_state table
+
+Revision ID: 6f7a8b9c0d1e
+Revises: 5e6f7a8b9c0d
+Create Date: 2026-10-17 14:00:00.000000
+
+"""
+import time
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6f7a8b9c0d1e'
+down_revision = '5e6f7a8b9c0d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    library_state = op.create_table('library_state',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.Float(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.bulk_insert(library_state, [{'id': 1, 'version': 1, 'updated_at': time.time()}])
+
+
+def downgrade():
+    op.drop_table('library_state')
@@ -0,0 +1,32 @@
+"""create rag_books table
+
+Revision ID: 7a8b9c0d1e2f
+Revises: 6f7a8b9c0d1e
+Create Date: 2026-10-17 14:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7a8b9c0d1e2f'
+down_revision = '6f7a8b9c0d1e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('rag_books',
+    sa.Column('book_id', sa.String(), nullable=False),
+    sa.Column('library_book_id', sa.Integer(), nullable=True),
+    sa.Column('chunk_count', sa.Integer(), nullable=False),
+    sa.Column('indexed_at', sa.Float(), nullable=False),
+    sa.PrimaryKeyConstraint('book_id')
+    )
+    op.create_index(op.f('ix_rag_books_library_book_id'), 'rag_books', ['library_book_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_rag_books_library_book_id'), table_name='rag_books')
+    op.drop_table('rag_books')
@@ -0,0 +1,42 @@
+"""create rag_index_jobs table
+
+Revision ID: 8b9c0d1e2f3a
+Revises: 7a8b9c0d1e2f
+Create Date: 2026-10-17 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b9c0d1e2f3a'
+down_revision = '7a8b9c0d1e2f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('rag_index_jobs',
+    sa.Column('id', sa.String(), nullable=False),
+    sa.Column('book_id', sa.String(), nullable=False),
+    sa.Column('library_book_id', sa.Integer(), nullable=True),
+    sa.Column('file_path', sa.String(), nullable=False),
+    sa.Column('temporary_file', sa.Boolean(), nullable=False),
+    sa.Column('status', sa.String(), nullable=False),
+    sa.Column('chunks_done', sa.Integer(), nullable=False),
+    sa.Column('chunks_total', sa.Integer(), nullable=True),
+    sa.Column('detail', sa.Text(), nullable=True),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.Float(), nullable=False),
+    sa.Column('updated_at', sa.Float(), nullable=False),
+    sa.Column('run_started_at', sa.Float(), nullable=True),
+    sa.Column('run_start_chunk', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_rag_index_jobs_book_id'), 'rag_index_jobs', ['book_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_rag_index_jobs_book_id'), table_name='rag_index_jobs')
+    op.drop_table('rag_index_jobs')
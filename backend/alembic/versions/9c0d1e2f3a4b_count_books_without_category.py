@@ -0,0 +1,30 @@
+"""count books without category as Desconocido
+
+Revision ID: 9c0d1e2f3a4b
+Revises: 8b9c0d1e2f3a
+Create Date: 2026-10-17 15:30:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '9c0d1e2f3a4b'
+down_revision = '8b9c0d1e2f3a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Los libros con categoría nula no figuraban en category_counts ni, por tanto, en el total
+    op.execute("UPDATE books SET category = 'Desconocido' WHERE category IS NULL")
+    op.execute("DELETE FROM category_counts WHERE category = 'Desconocido'")
+    op.execute(
+        "INSERT INTO category_counts (category, book_count) "
+        "SELECT category, COUNT(*) FROM books WHERE category = 'Desconocido' GROUP BY category"
+    )
+
+
+def downgrade():
+    # La normalización de datos no se deshace
+    pass
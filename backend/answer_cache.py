@@ -0,0 +1,88 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# Cache of generated RAG answers per scope (the sorted ids of the books queried), with LRU eviction and a TTL.
+ANSWER_CACHE_SIZE = int(os.getenv("RAG_ANSWER_CACHE_SIZE", 1000))
+ANSWER_CACHE_TTL = float(os.getenv("RAG_ANSWER_CACHE_TTL", 24 * 3600)) # Seconds
+# Minimum cosine similarity between query embeddings to reuse an answer (0 disables the semantic match)
+ANSWER_CACHE_SIMILARITY = float(os.getenv("RAG_ANSWER_CACHE_SIMILARITY", 0.95))
+
+# (scope, normalized query) -> {"answer", "embedding", "created_at"}
+_entries: OrderedDict[tuple[tuple[str, ...], str], dict] = OrderedDict()
+_lock = threading.Lock()
+
+def normalize_query(query: str) -> str:
+    """Lowercases the query and ignores whitespace and leading/trailing punctuation differences ("¿...?")."""
+    return re.sub(r"\s+", " ", query).strip().strip("?¿!¡.").strip().lower()
+
+def _unit(vector: list[float]) -> np.ndarray:
+    """Scales a vector to unit length so cosine similarity becomes a plain dot product."""
+    array = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(array)
+    return array / norm if norm else array
+
+def _is_expired(entry: dict, now: float) -> bool:
+    return now - entry["created_at"] > ANSWER_CACHE_TTL
+
+def get_exact(scope: tuple[str, ...], query: str) -> dict | None:
+    """Returns the cached answer for the same question about the same books, if any."""
+    key = (scope, normalize_query(query))
+    now = time.time()
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None:
+            return None
+        if _is_expired(entry, now):
+            del _entries[key]
+            return None
+        _entries.move_to_end(key)
+        return entry["answer"]
+
+def get_similar(scope: tuple[str, ...], embedding: list[float]) -> tuple[dict, float] | None:
+    """
+    Returns (answer, similarity) for the most similar cached question about the same books
+    when it reaches ANSWER_CACHE_SIMILARITY, or None.
+    """
+    if ANSWER_CACHE_SIMILARITY <= 0 or not embedding:
+        return None
+    query_vector = _unit(embedding)
+    now = time.time()
+    with _lock:
+        keys = []
+        for key, entry in list(_entries.items()):
+            if key[0] != scope:
+                continue
+            if _is_expired(entry, now):
+                del _entries[key]
+                continue
+            if entry["embedding"].shape == query_vector.shape:
+                keys.append(key)
+        if not keys:
+            return None
+        # One matrix-vector product over all the cached questions of the scope
+        similarities = np.stack([_entries[key]["embedding"] for key in keys]) @ query_vector
+        best = int(np.argmax(similarities))
+        if similarities[best] < ANSWER_CACHE_SIMILARITY:
+            return None
+        _entries.move_to_end(keys[best])
+        return _entries[keys[best]]["answer"], float(similarities[best])
+
+def put(scope: tuple[str, ...], query: str, embedding: list[float], answer: dict):
+    """Stores an answer, evicting the least recently used entries beyond ANSWER_CACHE_SIZE."""
+    key = (scope, normalize_query(query))
+    with _lock:
+        _entries[key] = {"answer": answer, "embedding": _unit(embedding), "created_at": time.time()}
+        _entries.move_to_end(key)
+        while len(_entries) > ANSWER_CACHE_SIZE:
+            _entries.popitem(last=False)
+
+def invalidate(book_id: str):
+    """Drops every cached answer involving a book (e.g. after it is re-indexed)."""
+    with _lock:
+        for key in [key for key in _entries if book_id in key[0]]:
+            del _entries[key]
@@ -0,0 +1,92 @@
+import functools
+import re
+from typing import Iterable, Iterator
+
+import tiktoken
+
+CHUNK_MAX_TOKENS = 1000
+CHUNK_OVERLAP_TOKENS = 100
+
+# A segment ends after sentence punctuation followed by whitespace, or at a blank line (paragraph)
+_SEGMENT_BOUNDARY = re.compile(r"(?<=[.!?…])\s+|\n\s*\n")
+
+@functools.lru_cache(maxsize=None)
+def get_tokenizer():
+    """Returns the tokenizer used for token counting, loaded only once per process."""
+    return tiktoken.encoding_for_model("gpt-3.5-turbo")
+
+def _split_segments(text: str) -> list[str]:
+    """Splits text into sentence/paragraph segments, keeping the trailing whitespace with each one."""
+    segments = []
+    start = 0
+    for match in _SEGMENT_BOUNDARY.finditer(text):
+        segments.append(text[start:match.end()])
+        start = match.end()
+    segments.append(text[start:])
+    return segments
+
+def _iter_segments(texts: Iterable[str]) -> Iterator[str]:
+    """Yields complete segments from a stream of text pieces (e.g. pages or chapters)."""
+    buffer = ""
+    for piece in texts:
+        buffer += piece
+        *complete, buffer = _split_segments(buffer)
+        yield from complete
+    if buffer:
+        yield buffer
+
+def _overlap_tail(window: list[tuple[str, int]], overlap_tokens: int) -> list[tuple[str, int]]:
+    """Returns the trailing segments of a chunk that fit in the overlap budget."""
+    tail = []
+    total = 0
+    for segment, count in reversed(window):
+        if total + count > overlap_tokens:
+            break
+        tail.append((segment, count))
+        total += count
+    tail.reverse()
+    return tail
+
+def iter_chunks(texts: Iterable[str], max_tokens: int = CHUNK_MAX_TOKENS,
+                overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> Iterator[str]:
+    """
+    Streams chunks of at most ~max_tokens tokens from an iterable of text pieces.
+    Chunks end on sentence or paragraph boundaries and repeat up to overlap_tokens
+    tokens of whole sentences from the previous chunk. A single sentence longer than
+    max_tokens is cut by slicing its token array.
+    """
+    if overlap_tokens >= max_tokens:
+        raise ValueError("overlap_tokens must be smaller than max_tokens.")
+    tokenizer = get_tokenizer()
+    window: list[tuple[str, int]] = []
+    window_tokens = 0
+
+    for segment in _iter_segments(texts):
+        tokens = tokenizer.encode_ordinary(segment)
+        count = len(tokens)
+        if window and window_tokens + count > max_tokens:
+            yield "".join(s for s, _ in window)
+            window = _overlap_tail(window, overlap_tokens)
+            window_tokens = sum(c for _, c in window)
+            if window_tokens + count > max_tokens:
+                window, window_tokens = [], 0
+
+        if count > max_tokens:
+            step = max_tokens - overlap_tokens
+            starts = range(0, count - overlap_tokens, step)
+            for start in starts[:-1]:
+                yield tokenizer.decode(tokens[start:start + max_tokens])
+            last = tokens[starts[-1]:]
+            window, window_tokens = [(tokenizer.decode(last), len(last))], len(last)
+        else:
+            window.append((segment, count))
+            window_tokens += count
+
+    if window and "".join(s for s, _ in window).strip():
+        yield "".join(s for s, _ in window)
+
+def chunk_text(text: str, max_tokens: int = CHUNK_MAX_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> list[str]:
+    """Chunks text into smaller pieces based on token count, respecting sentence boundaries."""
+    if not text.strip():
+        return []
+    return [chunk for chunk in iter_chunks([text], max_tokens, overlap_tokens) if chunk.strip()]
@@ -0,0 +1,252 @@
+import asyncio
+import functools
+import hashlib
+import mimetypes
+import os
+import posixpath
+import shutil
+import tempfile
+import zipfile
+from urllib.parse import quote, unquote, urlsplit
+
+from bs4 import BeautifulSoup
+
+import ingest, jobs
+
+# --- Conversión de EPUB a PDF ---
+# La conversión se ejecuta como trabajo: cada capítulo se renderiza en el pool de procesos y los
+# PDF parciales se van uniendo en orden sobre el archivo de salida. Los PDF generados se guardan con
+# el hash del EPUB y la versión del conversor como nombre, así que convertir de nuevo el mismo
+# EPUB devuelve el archivo existente sin volver a renderizar.
+CONVERTER_VERSION = "3" # Incrementar al cambiar el renderizado para invalidar los PDF guardados
+# Capítulos renderizándose o esperando a ser añadidos a la vez; acota la memoria y el disco temporal
+RENDER_WINDOW = int(os.getenv("CONVERTER_RENDER_WINDOW", ingest.INGEST_WORKERS * 2))
+
+# El EPUB no se extrae: sus recursos se leen del ZIP mediante URL bajo esta base (.invalid
+# es un dominio reservado, así que nunca se confunde con un recurso externo real)
+EPUB_BASE_URL = "https://epub.invalid/"
+
+# Conversiones en curso por clave de caché, para no renderizar dos veces el mismo EPUB a la vez
+_in_flight: dict[str, str] = {}
+
+@functools.lru_cache(maxsize=None)
+def renderer_version() -> str:
+    import weasyprint
+    return f"{CONVERTER_VERSION}-weasyprint-{weasyprint.__version__}"
+
+def conversion_key(content_hash: str) -> str:
+    """Clave de caché: hash del EPUB de origen y versión del conversor y de WeasyPrint."""
+    return hashlib.sha256(f"{content_hash}\0{renderer_version()}".encode("utf-8")).hexdigest()
+
+def _zip_url_fetcher(archive: zipfile.ZipFile):
+    """
+    url_fetcher de WeasyPrint que sirve desde el ZIP abierto las URL bajo EPUB_BASE_URL
+    (capítulos, CSS, imágenes, fuentes) y las URL data:. Cualquier otra se rechaza, para que
+    un EPUB no pueda incrustar en el PDF archivos locales ni recursos de la red interna.
+    """
+    from weasyprint import default_url_fetcher
+
+    def fetcher(url: str):
+        if url.startswith("data:"):
+            return default_url_fetcher(url)
+        if not url.startswith(EPUB_BASE_URL):
+            raise ValueError(f"Recurso externo no permitido en la conversión: {url}")
+        name = unquote(urlsplit(url).path).lstrip('/')
+        result = {"string": archive.read(name), "redirected_url": url}
+        mime_type = mimetypes.guess_type(name)[0]
+        if mime_type:
+            result["mime_type"] = mime_type
+        return result
+    return fetcher
+
+def _find_opf(archive: zipfile.ZipFile) -> str:
+    """Ruta del manifiesto .opf dentro del ZIP, según META-INF/container.xml."""
+    try:
+        container = BeautifulSoup(archive.read('META-INF/container.xml'), 'lxml-xml')
+        rootfile = container.find('rootfile', {'media-type': 'application/oebps-package+xml'}) or container.find('rootfile')
+        if rootfile and rootfile.get('full-path') in archive.NameToInfo:
+            return rootfile['full-path']
+    except KeyError:
+        pass
+    # EPUB sin container.xml válido: primer .opf del archivo
+    opf_name = next((name for name in archive.namelist() if name.lower().endswith('.opf')), None)
+    if not opf_name:
+        raise Exception("No se pudo encontrar el archivo .opf en el EPUB.")
+    return opf_name
+
+def plan_conversion(epub_path: str) -> tuple[list[dict], list[str]]:
+    """
+    Lee el manifiesto del EPUB sin extraerlo. Devuelve las partes a renderizar en orden
+    (portada y capítulos del spine) y las hojas de estilo, como rutas dentro del ZIP.
+    """
+    with zipfile.ZipFile(epub_path, 'r') as archive:
+        # 1. Localizar y analizar el manifiesto .opf (en binario para autodetectar codificación)
+        opf_name = _find_opf(archive)
+        content_root = posixpath.dirname(opf_name)
+        opf_soup = BeautifulSoup(archive.read(opf_name), 'lxml-xml')
+        members = archive.NameToInfo
+
+    def member(href):
+        """Ruta dentro del ZIP de un href del manifiesto, o None si no existe."""
+        if not href:
+            return None
+        name = posixpath.normpath(posixpath.join(content_root, unquote(href)))
+        return name if name in members else None
+
+    # 2. Crear una página de portada si se encuentra
+    parts = []
+    cover_meta = opf_soup.find('meta', {'name': 'cover'})
+    if cover_meta:
+        cover_id = cover_meta.get('content')
+        cover_item = opf_soup.find('item', {'id': cover_id})
+        cover_name = member(cover_item.get('href')) if cover_item else None
+        if cover_name:
+            cover_html_string = f"<html><body style='text-align: center; margin: 0; padding: 0;'><img src='{EPUB_BASE_URL}{quote(cover_name)}' style='width: 100%; height: 100%; object-fit: contain;'/></body></html>"
+            parts.append({"string": cover_html_string})
+
+    # 3. Encontrar todos los archivos CSS
+    stylesheets = []
+    for css_item in opf_soup.find_all('item', {'media-type': 'text/css'}):
+        css_name = member(css_item.get('href'))
+        if css_name:
+            stylesheets.append(css_name)
+
+    # 4. Encontrar el orden de lectura (spine) y añadir los capítulos
+    spine_ids = [item.get('idref') for item in opf_soup.find('spine').find_all('itemref')]
+    html_paths_map = {item['id']: item['href'] for item in opf_soup.find_all('item', {'media-type': 'application/xhtml+xml'})}
+
+    for chapter_id in spine_ids:
+        chapter_name = member(html_paths_map.get(chapter_id))
+        if chapter_name:
+            parts.append({"member": chapter_name})
+
+    if not parts:
+        raise Exception("No se encontró contenido HTML en el EPUB.")
+    return parts, stylesheets
+
+@functools.lru_cache(maxsize=8)
+def _load_stylesheets(epub_path: str, names: tuple[str, ...]) -> list:
+    """Hojas de estilo ya analizadas, reutilizadas por el proceso para todos los capítulos del libro."""
+    from weasyprint import CSS
+    with zipfile.ZipFile(epub_path, 'r') as archive:
+        fetcher = _zip_url_fetcher(archive)
+        return [CSS(url=f"{EPUB_BASE_URL}{quote(name)}", url_fetcher=fetcher) for name in names]
+
+def render_part(epub_path: str, part: dict, stylesheets: tuple[str, ...], part_path: str) -> int:
+    """Renderiza una parte (portada o capítulo) a su propio PDF. Se ejecuta en el pool de procesos."""
+    from weasyprint import HTML
+
+    with zipfile.ZipFile(epub_path, 'r') as archive:
+        fetcher = _zip_url_fetcher(archive)
+        if "string" in part:
+            html = HTML(string=part["string"], url_fetcher=fetcher)
+        else:
+            html = HTML(url=f"{EPUB_BASE_URL}{quote(part['member'])}", url_fetcher=fetcher, encoding='utf-8')
+        document = html.render(stylesheets=_load_stylesheets(epub_path, stylesheets))
+        document.write_pdf(target=part_path)
+    return len(document.pages)
+
+def append_part(pdf_path: str, part_path: str):
+    """
+    Añade las páginas de un PDF parcial al final del PDF de salida con una actualización
+    incremental: solo se escriben los objetos nuevos y el documento no se mantiene abierto.
+    """
+    import fitz
+
+    with fitz.open(pdf_path) as merged, fitz.open(part_path) as part:
+        merged.insert_pdf(part)
+        if merged.can_save_incrementally():
+            merged.saveIncr()
+        else:
+            # El PDF de salida necesitó reparación al abrirlo: se reescribe completo
+            merged.save(f"{pdf_path}.merge")
+    if os.path.exists(f"{pdf_path}.merge"):
+        os.replace(f"{pdf_path}.merge", pdf_path)
+    os.remove(part_path)
+
+async def render_epub_to_pdf(epub_path: str, pdf_path: str, executor, on_progress=None):
+    """
+    Convierte un EPUB a PDF renderizando cada capítulo en un proceso del pool. Como mucho
+    RENDER_WINDOW capítulos están en vuelo a la vez, y cada uno se añade al PDF de salida en
+    cuanto le toca, así que la memoria no depende del tamaño del libro.
+    """
+    loop = asyncio.get_running_loop()
+    temp_pdf_path = f"{pdf_path}.tmp"
+    # Los PDF parciales van al directorio temporal del sistema, fuera de la carpeta servida como estática
+    with tempfile.TemporaryDirectory() as work_dir:
+        parts, stylesheets = await asyncio.to_thread(plan_conversion, epub_path)
+        stylesheets = tuple(stylesheets)
+        part_paths = [os.path.join(work_dir, f"part_{i:05d}.pdf") for i in range(len(parts))]
+
+        def submit(i):
+            return loop.run_in_executor(executor, render_part, epub_path, parts[i], stylesheets, part_paths[i])
+
+        pending = {i: submit(i) for i in range(min(RENDER_WINDOW, len(parts)))}
+        try:
+            for i in range(len(parts)):
+                await pending.pop(i)
+                if i + RENDER_WINDOW < len(parts):
+                    pending[i + RENDER_WINDOW] = submit(i + RENDER_WINDOW)
+                # Las partes se añaden en orden directamente al archivo de salida
+                if i == 0:
+                    # Copia y no os.replace: el temporal puede estar en otro sistema de archivos
+                    await asyncio.to_thread(shutil.copyfile, part_paths[0], temp_pdf_path)
+                    os.remove(part_paths[0])
+                else:
+                    await asyncio.to_thread(append_part, temp_pdf_path, part_paths[i])
+                if on_progress is not None:
+                    on_progress(i + 1, len(parts))
+        except BaseException:
+            for future in pending.values():
+                future.cancel()
+            await asyncio.gather(*pending.values(), return_exceptions=True)
+            _remove_file(temp_pdf_path)
+            raise
+
+    # Publicar el PDF solo cuando está completo
+    os.replace(temp_pdf_path, pdf_path)
+
+def _remove_file(file_path: str):
+    if file_path and os.path.exists(file_path):
+        os.remove(file_path)
+
+async def run_conversion_job(job_id: str, key: str, epub_path: str, pdf_path: str, download_url: str):
+    """Convierte el EPUB en el pool de procesos informando del estado del trabajo."""
+    try:
+        jobs.update_job(job_id, status="running", stage="rendering", progress=0.0)
+        await render_epub_to_pdf(
+            epub_path, pdf_path, ingest.get_executor(),
+            on_progress=lambda done, total: jobs.update_job(job_id, progress=done / total)
+        )
+        jobs.complete_job(job_id, result={"download_url": download_url, "cached": False})
+    except Exception as e:
+        error_message = f"Error durante la conversión: {type(e).__name__}: {e}"
+        print(error_message)
+        jobs.fail_job(job_id, error_message)
+    finally:
+        _in_flight.pop(key, None)
+        _remove_file(epub_path)
+
+def start_conversion(epub_path: str, content_hash: str, filename: str, output_dir: str, url_prefix: str) -> dict:
+    """
+    Lanza la conversión de un EPUB ya guardado en disco y devuelve su trabajo. Si ese EPUB ya se
+    convirtió con la misma versión del conversor, el trabajo se devuelve completado al instante;
+    si se está convirtiendo, se devuelve el trabajo en curso.
+    """
+    key = conversion_key(content_hash)
+    pdf_filename = f"{key}.pdf"
+    pdf_path = os.path.join(output_dir, pdf_filename)
+    download_url = f"{url_prefix}/{pdf_filename}"
+
+    if os.path.exists(pdf_path):
+        _remove_file(epub_path)
+        job = jobs.create_job("convert", filename=filename)
+        return jobs.complete_job(job["id"], result={"download_url": download_url, "cached": True})
+    if key in _in_flight:
+        _remove_file(epub_path)
+        return jobs.get_job(_in_flight[key])
+
+    job = jobs.create_job("convert", filename=filename)
+    _in_flight[key] = job["id"]
+    jobs.run_in_background(run_conversion_job(job["id"], key, epub_path, pdf_path, download_url))
+    return job
@@ -1,58 +1,230 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import desc, or_
+from sqlalchemy import desc, or_, and_, text, func, Integer, Float
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from collections import Counter
 import models
+import extraction
 import os
+import json
+import re
+import base64
+import time
+
+# Columnas de "books" que se pueden pedir en una proyección
+BOOK_FIELDS = ("id", "title", "author", "category", "cover_image_url", "file_path", "content_hash")
+
+# Pesos bm25 de las columnas del índice FTS5: título, autor, categoría
+FTS_WEIGHTS = (10.0, 5.0, 1.0)
+
+def _fts_match_expression(term: str, column: str | None = None) -> str | None:
+    """
+    Convierte un texto libre en una expresión MATCH de FTS5 con coincidencia por prefijo
+    (cada palabra como "palabra"*). Devuelve None si el texto no contiene palabras.
+    """
+    words = re.findall(r"\w+", term)
+    if not words:
+        return None
+    expression = " ".join(f'"{word}"*' for word in words)
+    return f"{column} : ({expression})" if column else expression
+
+def _fts_ranked_query(match: str):
+    """Subconsulta sobre books_fts con los ids que cumplen la expresión y su puntuación bm25."""
+    weights = ", ".join(str(w) for w in FTS_WEIGHTS)
+    return text(
+        f"SELECT rowid AS book_id, bm25(books_fts, {weights}) AS rank FROM books_fts WHERE books_fts MATCH :match"
+    ).bindparams(match=match).columns(book_id=Integer, rank=Float).subquery()
+
+def get_book(db: Session, book_id: int):
+    """Obtiene un libro por su ID."""
+    return db.query(models.Book).filter(models.Book.id == book_id).first()
 
 def get_book_by_path(db: Session, file_path: str):
     """Obtiene un libro por su ruta de archivo."""
     return db.query(models.Book).filter(models.Book.file_path == file_path).first()
 
+def get_book_by_hash(db: Session, content_hash: str):
+    """Obtiene un libro por el hash SHA-256 de su contenido."""
+    return db.query(models.Book).filter(models.Book.content_hash == content_hash).first()
+
 def get_book_by_title(db: Session, title: str):
     """Obtiene un libro por su título exacto."""
     return db.query(models.Book).filter(models.Book.title == title).first()
 
 def get_books_by_partial_title(db: Session, title: str, skip: int = 0, limit: int = 100):
-    """Busca libros por un título parcial (case-insensitive)."""
-    return db.query(models.Book).filter(models.Book.title.ilike(f"%{title}%")).offset(skip).limit(limit).all()
+    """Busca libros por un título parcial usando el índice de texto completo, ordenados por relevancia."""
+    match = _fts_match_expression(title, column="title")
+    if match is None:
+        return db.query(models.Book).filter(models.Book.title.ilike(f"%{title}%")).offset(skip).limit(limit).all()
+    ranked = _fts_ranked_query(match)
+    return (
+        db.query(models.Book)
+        .join(ranked, models.Book.id == ranked.c.book_id)
+        .order_by(ranked.c.rank, desc(models.Book.id))
+        .offset(skip).limit(limit).all()
+    )
 
-def get_books(db: Session, category: str | None = None, search: str | None = None, author: str | None = None):
-    """Obtiene una lista de libros, con opciones de filtrado por categoría, búsqueda general y autor."""
-    query = db.query(models.Book)
+def _filtered_books_query(db: Session, columns: list, category: str | None, search: str | None, author: str | None):
+    """
+    Construye la consulta filtrada de libros. La búsqueda y el autor se resuelven con el índice
+    FTS5 (por prefijo); en ese caso devuelve también la subconsulta con la puntuación bm25.
+    """
+    query = db.query(*columns)
     if category:
         query = query.filter(models.Book.category == category)
+
+    matches = []
     if author:
-        query = query.filter(models.Book.author.ilike(f"%{author}%"))
+        author_match = _fts_match_expression(author, column="author")
+        if author_match:
+            matches.append(author_match)
+        else:
+            query = query.filter(models.Book.author.ilike(f"%{author}%"))
     if search:
-        search_term = f"%{search}%"
-        query = query.filter(
-            or_(
-                models.Book.title.ilike(search_term),
-                models.Book.author.ilike(search_term),
-                models.Book.category.ilike(search_term)
+        search_match = _fts_match_expression(search)
+        if search_match:
+            matches.append(search_match)
+        else:
+            search_term = f"%{search}%"
+            query = query.filter(
+                or_(
+                    models.Book.title.ilike(search_term),
+                    models.Book.author.ilike(search_term),
+                    models.Book.category.ilike(search_term)
+                )
             )
-        )
+
+    if not matches:
+        return query, None
+    ranked = _fts_ranked_query(" AND ".join(f"({m})" for m in matches))
+    return query.join(ranked, models.Book.id == ranked.c.book_id), ranked
+
+def get_books(db: Session, category: str | None = None, search: str | None = None, author: str | None = None):
+    """Obtiene una lista de libros, con opciones de filtrado por categoría, búsqueda general y autor."""
+    query, ranked = _filtered_books_query(db, [models.Book], category, search, author)
+    if ranked is not None:
+        return query.order_by(ranked.c.rank, desc(models.Book.id)).all()
     return query.order_by(desc(models.Book.id)).all()
 
+def encode_cursor(book_id: int, rank: float | None = None) -> str:
+    payload = {"id": book_id} if rank is None else {"id": book_id, "rank": rank}
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+def decode_cursor(cursor: str) -> dict:
+    """Decodifica un cursor opaco de paginación. Lanza ValueError si no es válido."""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return {"id": int(payload["id"]), "rank": float(payload["rank"]) if "rank" in payload else None}
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError("Cursor de paginación no válido.") from e
+
+def get_books_page(db: Session, category: str | None = None, search: str | None = None, author: str | None = None,
+                   cursor: str | None = None, limit: int = 50, fields: list[str] | None = None):
+    """
+    Obtiene una página de libros con paginación por clave (keyset) sobre el id, de modo que
+    cada página cuesta lo mismo sin importar su posición. Con búsqueda, la clave es (bm25, id).
+    Con fields, solo se leen esas columnas. Devuelve (filas, cursor_siguiente).
+    """
+    field_names = ["id"] + [f for f in (fields or BOOK_FIELDS) if f != "id"]
+    columns = [getattr(models.Book, f) for f in field_names]
+    query, ranked = _filtered_books_query(db, columns, category, search, author)
+    after = decode_cursor(cursor) if cursor else None
+
+    if ranked is not None:
+        query = query.add_columns(ranked.c.rank)
+        if after:
+            rank = after["rank"] if after["rank"] is not None else float("-inf")
+            query = query.filter(or_(ranked.c.rank > rank, and_(ranked.c.rank == rank, models.Book.id < after["id"])))
+        query = query.order_by(ranked.c.rank, desc(models.Book.id))
+    else:
+        if after:
+            query = query.filter(models.Book.id < after["id"])
+        query = query.order_by(desc(models.Book.id))
+
+    rows = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(last.id, last.rank if ranked is not None else None)
+    return [{f: getattr(row, f) for f in field_names} for row in rows], next_cursor
+
+def _adjust_category_counts(db: Session, deltas: Counter):
+    """
+    Actualiza de forma incremental la tabla de agregados category_counts dentro de la
+    transacción en curso y elimina las categorías que se quedan sin libros.
+    """
+    for category, delta in deltas.items():
+        if category is None or delta == 0:
+            continue
+        statement = sqlite_insert(models.CategoryCount).values(category=category, book_count=delta)
+        db.execute(statement.on_conflict_do_update(
+            index_elements=[models.CategoryCount.category],
+            set_={"book_count": models.CategoryCount.book_count + delta},
+        ))
+    db.query(models.CategoryCount).filter(models.CategoryCount.book_count <= 0).delete(synchronize_session=False)
+
+def _bump_library_version(db: Session):
+    """Incrementa la versión de la biblioteca (usada para ETag/Last-Modified) en la transacción en curso."""
+    statement = sqlite_insert(models.LibraryState).values(id=1, version=1, updated_at=time.time())
+    db.execute(statement.on_conflict_do_update(
+        index_elements=[models.LibraryState.id],
+        set_={"version": models.LibraryState.version + 1, "updated_at": statement.excluded.updated_at},
+    ))
+
+def get_library_version(db: Session) -> tuple[int, float]:
+    """Obtiene la versión actual de la biblioteca y la fecha de su última modificación."""
+    state = db.get(models.LibraryState, 1)
+    return (state.version, state.updated_at) if state else (0, 0.0)
+
 def get_categories(db: Session) -> list[str]:
     """Obtiene una lista de todas las categorías de libros únicas."""
-    return [c[0] for c in db.query(models.Book.category).distinct().order_by(models.Book.category).all()]
+    return [c[0] for c in db.query(models.CategoryCount.category).order_by(models.CategoryCount.category).all()]
+
+def get_category_counts(db: Session) -> list[models.CategoryCount]:
+    """Obtiene las categorías con su número de libros, leyendo solo la tabla de agregados."""
+    return db.query(models.CategoryCount).order_by(models.CategoryCount.category).all()
 
-def create_book(db: Session, title: str, author: str, category: str, cover_image_url: str, file_path: str):
+def create_book(db: Session, title: str, author: str, category: str, cover_image_url: str, file_path: str, content_hash: str | None = None):
     """Crea un nuevo libro en la base de datos."""
     db_book = models.Book(
         title=title,
         author=author,
         category=category,
         cover_image_url=cover_image_url,
-        file_path=file_path
+        file_path=file_path,
+        content_hash=content_hash
     )
     db.add(db_book)
+    _adjust_category_counts(db, Counter([category]))
+    _bump_library_version(db)
     db.commit()
     db.refresh(db_book)
     return db_book
 
+def create_books(db: Session, books: list[dict]):
+    """Crea varios libros en una sola transacción (inserción por lotes)."""
+    db_books = [models.Book(**book) for book in books]
+    db.add_all(db_books)
+    _adjust_category_counts(db, Counter(book.category for book in db_books))
+    _bump_library_version(db)
+    db.commit()
+    for db_book in db_books:
+        db.refresh(db_book)
+    return db_books
+
+def _delete_rag_records(db: Session, library_book_ids: list[int]):
+    """
+    Elimina los registros RAG (índice y trabajos de indexación) de libros de la biblioteca dentro de
+    la transacción en curso. Sus vectores los borra el llamador con rag.delete_book_index.
+    """
+    rag_book_ids = [str(book_id) for book_id in library_book_ids]
+    db.query(models.RagBook).filter(
+        or_(models.RagBook.library_book_id.in_(library_book_ids), models.RagBook.book_id.in_(rag_book_ids))
+    ).delete(synchronize_session=False)
+    db.query(models.RagIndexJob).filter(models.RagIndexJob.book_id.in_(rag_book_ids)).delete(synchronize_session=False)
+
 def delete_book(db: Session, book_id: int):
-    """Elimina un libro de la base de datos por su ID, incluyendo sus archivos asociados."""
+    """Elimina un libro de la base de datos por su ID, incluyendo sus archivos asociados y sus registros RAG."""
     book = db.query(models.Book).filter(models.Book.id == book_id).first()
     if book:
         # Eliminar archivos asociados
@@ -60,16 +232,23 @@ def delete_book(db: Session, book_id: int):
             os.remove(book.file_path)
         if book.cover_image_url and os.path.exists(book.cover_image_url):
             os.remove(book.cover_image_url)
+        extraction.delete_artifact(book.content_hash)
         
         db.delete(book)
+        _delete_rag_records(db, [book.id])
+        _adjust_category_counts(db, Counter({book.category: -1}))
+        _bump_library_version(db)
         db.commit()
     return book
 
-def delete_books_by_category(db: Session, category: str):
-    """Elimina todos los libros de una categoría específica, incluyendo sus archivos asociados."""
+def delete_books_by_category(db: Session, category: str) -> list[int]:
+    """
+    Elimina todos los libros de una categoría específica, incluyendo sus archivos asociados y
+    sus registros RAG. Retorna los ids de los libros eliminados.
+    """
     books_to_delete = db.query(models.Book).filter(models.Book.category == category).all()
     if not books_to_delete:
-        return 0
+        return []
     
     for book in books_to_delete:
         # Eliminar archivos asociados
@@ -77,12 +256,117 @@ def delete_books_by_category(db: Session, category: str):
             os.remove(book.file_path)
         if book.cover_image_url and os.path.exists(book.cover_image_url):
             os.remove(book.cover_image_url)
+        extraction.delete_artifact(book.content_hash)
         db.delete(book)
         
-    count = len(books_to_delete)
+    deleted_ids = [book.id for book in books_to_delete]
+    _delete_rag_records(db, deleted_ids)
+    _adjust_category_counts(db, Counter({category: -len(deleted_ids)}))
+    _bump_library_version(db)
     db.commit()
-    return count
+    return deleted_ids
 
 def get_books_count(db: Session) -> int:
-    """Obtiene el número total de libros en la base de datos."""
-    return db.query(models.Book).count()
+    """Obtiene el número total de libros a partir de la tabla de agregados, sin recorrer "books"."""
+    return db.query(func.coalesce(func.sum(models.CategoryCount.book_count), 0)).scalar()
+
+def get_cached_analyses(db: Session, keys: list[str]) -> dict:
+    """Obtiene los análisis de IA guardados en caché para las claves indicadas."""
+    rows = db.query(models.AnalysisCache).filter(models.AnalysisCache.key.in_(keys)).all()
+    return {row.key: json.loads(row.result) for row in rows}
+
+def save_cached_analyses(db: Session, entries: dict):
+    """Guarda (o reemplaza) análisis de IA en la caché."""
+    for key, result in entries.items():
+        db.merge(models.AnalysisCache(key=key, result=json.dumps(result, ensure_ascii=False)))
+    db.commit()
+
+def get_rag_book(db: Session, book_id: str):
+    """Obtiene el registro de un libro ya indexado para RAG."""
+    return db.query(models.RagBook).filter(models.RagBook.book_id == book_id).first()
+
+def get_rag_books(db: Session):
+    """Obtiene todos los libros indexados para RAG."""
+    return db.query(models.RagBook).order_by(desc(models.RagBook.indexed_at)).all()
+
+def get_rag_book_ids(db: Session) -> set[str]:
+    """Ids de todos los libros que deben conservar sus vectores: los indexados y los que se están indexando."""
+    indexed = {row[0] for row in db.query(models.RagBook.book_id).all()}
+    in_progress = {row[0] for row in db.query(models.RagIndexJob.book_id).filter(models.RagIndexJob.status != "completed").all()}
+    return indexed | in_progress
+
+def get_rag_scope(db: Session, book_ids: list[str] | None = None, category: str | None = None) -> dict[str, str | None]:
+    """
+    Obtiene los libros indexados para RAG que abarca una consulta (unos ids concretos, una
+    categoría de la biblioteca o, sin filtros, todos), con el título de los que están en la biblioteca.
+    """
+    query = db.query(models.RagBook.book_id, models.Book.title).outerjoin(
+        models.Book, models.Book.id == models.RagBook.library_book_id
+    )
+    if book_ids is not None:
+        query = query.filter(models.RagBook.book_id.in_(book_ids))
+    if category is not None:
+        query = query.filter(models.Book.category == category)
+    return {book_id: title for book_id, title in query.all()}
+
+def save_rag_book(db: Session, book_id: str, chunk_count: int, library_book_id: int | None = None):
+    """Registra (o actualiza) un libro como indexado para RAG."""
+    rag_book = db.merge(models.RagBook(
+        book_id=book_id,
+        library_book_id=library_book_id,
+        chunk_count=chunk_count,
+        indexed_at=time.time()
+    ))
+    db.commit()
+    return rag_book
+
+def create_rag_index_job(db: Session, job_id: str, book_id: str, file_path: str, temporary_file: bool,
+                         library_book_id: int | None = None, content_hash: str | None = None):
+    """Registra un trabajo de indexación RAG persistente en estado 'pending'."""
+    now = time.time()
+    job = models.RagIndexJob(
+        id=job_id,
+        book_id=book_id,
+        library_book_id=library_book_id,
+        file_path=file_path,
+        content_hash=content_hash,
+        temporary_file=temporary_file,
+        status="pending",
+        chunks_done=0,
+        attempts=0,
+        created_at=now,
+        updated_at=now,
+        run_start_chunk=0
+    )
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job
+
+def get_rag_index_job(db: Session, job_id: str):
+    """Obtiene un trabajo de indexación RAG por su id."""
+    return db.get(models.RagIndexJob, job_id)
+
+def get_active_rag_index_job(db: Session, book_id: str):
+    """Obtiene el trabajo de indexación sin terminar (pendiente, en curso o fallido) de un libro, si lo hay."""
+    return (
+        db.query(models.RagIndexJob)
+        .filter(models.RagIndexJob.book_id == book_id, models.RagIndexJob.status != "completed")
+        .order_by(desc(models.RagIndexJob.created_at))
+        .first()
+    )
+
+def get_unfinished_rag_index_jobs(db: Session):
+    """Obtiene los trabajos que quedaron pendientes o en curso (p. ej. tras un reinicio)."""
+    return db.query(models.RagIndexJob).filter(models.RagIndexJob.status.in_(["pending", "running"])).all()
+
+def update_rag_index_job(db: Session, job_id: str, **fields):
+    """Actualiza los campos de un trabajo de indexación RAG y guarda el cambio."""
+    job = db.get(models.RagIndexJob, job_id)
+    if job is None:
+        return None
+    for name, value in fields.items():
+        setattr(job, name, value)
+    job.updated_at = time.time()
+    db.commit()
+    return job
@@ -0,0 +1,74 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from array import array
+
+# Content-addressed embedding cache: the key is a hash of (model, task_type, text),
+# so the same chunk is never embedded twice, whatever book_id it is stored under.
+EMBEDDING_CACHE_PATH = os.getenv("RAG_EMBEDDING_CACHE_PATH", "embedding_cache.sqlite3")
+
+_connection: sqlite3.Connection | None = None
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0}
+
+def _get_connection() -> sqlite3.Connection:
+    """Opens the cache database on first use (shared across threads, guarded by _lock)."""
+    global _connection
+    if _connection is None:
+        _connection = sqlite3.connect(EMBEDDING_CACHE_PATH, check_same_thread=False)
+        _connection.execute("PRAGMA journal_mode=WAL")
+        _connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB NOT NULL)")
+    return _connection
+
+def cache_key(model: str, task_type: str, text: str) -> bytes:
+    """Returns the SHA-256 digest identifying an embedding."""
+    return hashlib.sha256(f"{model}\0{task_type}\0{text}".encode("utf-8")).digest()
+
+def _encode(embedding: list[float]) -> bytes:
+    return array("f", embedding).tobytes()
+
+def _decode(blob: bytes) -> list[float]:
+    vector = array("f")
+    vector.frombytes(blob)
+    return vector.tolist()
+
+def get_many(model: str, task_type: str, texts: list[str]) -> list[list[float] | None]:
+    """Looks up several texts at once. Returns the cached embedding or None for each text."""
+    keys = [cache_key(model, task_type, text) for text in texts]
+    found = {}
+    with _lock:
+        connection = _get_connection()
+        for start in range(0, len(keys), 500): # Stay under SQLite's bound-parameter limit
+            batch = keys[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            found.update(connection.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+            ).fetchall())
+        hits = sum(1 for key in keys if key in found)
+        _stats["hits"] += hits
+        _stats["misses"] += len(keys) - hits
+    return [_decode(found[key]) if key in found else None for key in keys]
+
+def put_many(model: str, task_type: str, texts: list[str], embeddings: list[list[float]]):
+    """Stores embeddings as float32 arrays."""
+    rows = [(cache_key(model, task_type, text), _encode(embedding)) for text, embedding in zip(texts, embeddings) if embedding]
+    if not rows:
+        return
+    with _lock:
+        connection = _get_connection()
+        connection.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", rows)
+        connection.commit()
+
+def get_stats() -> dict:
+    """Returns hit/miss counters since startup and the number of stored embeddings."""
+    with _lock:
+        entries = _get_connection().execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        hits, misses = _stats["hits"], _stats["misses"]
+    lookups = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / lookups if lookups else 0.0,
+        "entries": entries,
+    }
@@ -0,0 +1,83 @@
+import functools
+import os
+import re
+import zlib
+from abc import ABC, abstractmethod
+
+import numpy as np
+import google.generativeai as genai
+
+# Embedding backends for the RAG, selected with RAG_EMBEDDING_PROVIDER ("gemini" or "hashing").
+EMBEDDING_PROVIDER = os.getenv("RAG_EMBEDDING_PROVIDER", "gemini")
+GEMINI_EMBEDDING_MODEL = "models/text-embedding-004"
+HASHING_DIMENSIONS = int(os.getenv("RAG_HASHING_DIMENSIONS", 768))
+
+_TOKEN = re.compile(r"\w+")
+
+class EmbeddingProvider(ABC):
+    """
+    Turns texts into vectors. name identifies the model (it is part of the embedding cache
+    key and of the vector collection name), batch_size is the largest batch per embed() call
+    and cacheable says whether results are worth storing in the embedding cache.
+    """
+    name: str
+    batch_size: int
+    cacheable: bool = True
+
+    @abstractmethod
+    def embed(self, texts: list[str], task_type: str = "RETRIEVAL_DOCUMENT") -> list[list[float]]:
+        """Returns one vector per text, in order."""
+
+class GeminiEmbeddingProvider(EmbeddingProvider):
+    """Remote embeddings from the Gemini API (one network round trip per batch)."""
+    batch_size = 100 # Maximum number of texts per batch embedding request
+
+    def __init__(self, model: str = GEMINI_EMBEDDING_MODEL):
+        self.name = model
+
+    def embed(self, texts: list[str], task_type: str = "RETRIEVAL_DOCUMENT") -> list[list[float]]:
+        return genai.embed_content(model=self.name, content=texts, task_type=task_type)["embedding"]
+
+class HashingEmbeddingProvider(EmbeddingProvider):
+    """
+    Local, deterministic embeddings on the CPU: words and word bigrams are hashed (CRC32, stable
+    across processes) into a fixed number of signed buckets, counts are log-scaled and every row is
+    L2-normalized. No model files and no network, so indexing can be measured and run offline.
+    """
+    batch_size = 1000
+    cacheable = False # Recomputing is cheaper than a cache lookup
+
+    def __init__(self, dimensions: int = HASHING_DIMENSIONS):
+        self.dimensions = dimensions
+        self.name = f"local-hashing-{dimensions}"
+
+    def _features(self, text: str) -> list[str]:
+        words = _TOKEN.findall(text.lower())
+        return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+    def embed(self, texts: list[str], task_type: str = "RETRIEVAL_DOCUMENT") -> list[list[float]]:
+        rows, hashes = [], []
+        for row, text in enumerate(texts):
+            features = self._features(text)
+            rows.extend([row] * len(features))
+            hashes.extend(zlib.crc32(feature.encode("utf-8")) for feature in features)
+        hashes = np.asarray(hashes, dtype=np.uint32)
+        signs = np.where(hashes & 0x80000000, -1.0, 1.0).astype(np.float32)
+        matrix = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        np.add.at(matrix, (np.asarray(rows, dtype=np.intp), hashes % self.dimensions), signs)
+        matrix = np.sign(matrix) * np.log1p(np.abs(matrix))
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        np.divide(matrix, norms, out=matrix, where=norms > 0)
+        return matrix.tolist()
+
+PROVIDERS = {
+    "gemini": GeminiEmbeddingProvider,
+    "hashing": HashingEmbeddingProvider,
+}
+
+@functools.lru_cache(maxsize=None)
+def get_provider(name: str = EMBEDDING_PROVIDER) -> EmbeddingProvider:
+    """Returns the configured embedding provider, created once per process."""
+    if name not in PROVIDERS:
+        raise ValueError(f"Unknown embedding provider: {name}. Use one of: {', '.join(PROVIDERS)}.")
+    return PROVIDERS[name]()
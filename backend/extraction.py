@@ -0,0 +1,115 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import uuid
+
+import ebooklib
+import fitz
+from bs4 import BeautifulSoup
+from ebooklib import epub
+
+# --- Extracción de texto única por libro ---
+# El texto completo de cada libro se extrae una sola vez (PyMuPDF para PDF) y se guarda comprimido
+# en disco, indexado por el hash SHA-256 del archivo. El análisis de la subida, la indexación RAG
+# y cualquier búsqueda futura leen ese artefacto en lugar de volver a parsear el archivo.
+EXTRACTED_TEXT_DIR = os.getenv("EXTRACTED_TEXT_DIR", "extracted_text")
+PARALLEL_MIN_PAGES = int(os.getenv("EXTRACTION_PARALLEL_MIN_PAGES", 64)) # Por debajo, un único proceso
+PAGES_PER_TASK = int(os.getenv("EXTRACTION_PAGES_PER_TASK", 32))
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def file_hash(file_path: str) -> str:
+    """Hash SHA-256 del archivo, leído por bloques."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while block := f.read(HASH_CHUNK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+def pdf_page_count(file_path: str) -> int:
+    with fitz.open(file_path) as doc:
+        return len(doc)
+
+def extract_pdf_pages(file_path: str, start: int = 0, stop: int | None = None) -> list[str]:
+    """Texto de las páginas [start, stop) de un PDF, una cadena por página. Se ejecuta en el pool de procesos."""
+    with fitz.open(file_path) as doc:
+        stop = len(doc) if stop is None else min(stop, len(doc))
+        return [doc.load_page(i).get_text("text") for i in range(start, stop)]
+
+def extract_epub_chapters(file_path: str) -> list[str]:
+    """Texto de los documentos de un EPUB, uno por capítulo."""
+    book = epub.read_epub(file_path)
+    return [
+        BeautifulSoup(item.get_content(), 'html.parser').get_text()
+        for item in book.get_items_of_type(ebooklib.ITEM_DOCUMENT)
+    ]
+
+def _artifact_path(content_hash: str) -> str:
+    return os.path.join(EXTRACTED_TEXT_DIR, content_hash[:2], f"{content_hash}.json.gz")
+
+def read_artifact(content_hash: str) -> list[str] | None:
+    """Lee el texto ya extraído de un libro (lista de páginas o capítulos), o None si no existe."""
+    try:
+        with gzip.open(_artifact_path(content_hash), "rt", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def write_artifact(content_hash: str, pieces: list[str]):
+    """Guarda el texto extraído comprimido; se escribe en un archivo temporal y se renombra para no dejarlo a medias."""
+    path = _artifact_path(content_hash)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp" # Único también entre hilos del mismo proceso
+    with gzip.open(temp_path, "wt", encoding="utf-8", compresslevel=6) as f:
+        json.dump(pieces, f, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+def delete_artifact(content_hash: str | None):
+    if content_hash and os.path.exists(_artifact_path(content_hash)):
+        os.remove(_artifact_path(content_hash))
+
+async def _run(executor, func, *args):
+    """Ejecuta en el pool de procesos si se proporciona; si no, en un hilo."""
+    if executor is None:
+        return await asyncio.to_thread(func, *args)
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+async def _extract_pdf(file_path: str, executor) -> list[str]:
+    """Reparte los PDF grandes por rangos de páginas entre los procesos del pool."""
+    page_count = await asyncio.to_thread(pdf_page_count, file_path)
+    if executor is None or page_count < PARALLEL_MIN_PAGES:
+        return await _run(executor, extract_pdf_pages, file_path)
+    ranges = [(start, start + PAGES_PER_TASK) for start in range(0, page_count, PAGES_PER_TASK)]
+    parts = await asyncio.gather(*(_run(executor, extract_pdf_pages, file_path, start, stop) for start, stop in ranges))
+    return [page for part in parts for page in part]
+
+async def load_text(file_path: str, content_hash: str | None = None, executor=None) -> list[str]:
+    """
+    Devuelve el texto del libro como lista de páginas (PDF) o capítulos (EPUB), extrayéndolo
+    y guardándolo solo la primera vez. Sin content_hash, se calcula a partir del archivo.
+    """
+    if content_hash is None:
+        content_hash = await asyncio.to_thread(file_hash, file_path)
+    pieces = await asyncio.to_thread(read_artifact, content_hash)
+    if pieces is not None:
+        return pieces
+
+    file_ext = os.path.splitext(file_path)[1].lower()
+    if file_ext == ".pdf":
+        pieces = await _extract_pdf(file_path, executor)
+    elif file_ext == ".epub":
+        pieces = await _run(executor, extract_epub_chapters, file_path)
+    else:
+        raise ValueError("Tipo de archivo no soportado.")
+    await asyncio.to_thread(write_artifact, content_hash, pieces)
+    return pieces
+
+def leading_text(pieces: list[str], min_chars: int) -> str:
+    """Texto del principio del libro: páginas o capítulos completos hasta reunir al menos min_chars caracteres."""
+    text = ""
+    for piece in pieces:
+        text += piece + "\n"
+        if len(text) > min_chars:
+            break
+    return text
@@ -0,0 +1,475 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import ebooklib
+import fitz
+import google.generativeai as genai
+from ebooklib import epub
+
+import crud, database, extraction, jobs
+
+# --- Configuración de la ingesta ---
+BOOKS_DIR = "books"
+SUPPORTED_EXTENSIONS = (".pdf", ".epub")
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", os.cpu_count() or 2))
+ANALYSIS_CONCURRENCY = int(os.getenv("ANALYSIS_CONCURRENCY", 4))
+INSERT_BATCH_SIZE = int(os.getenv("INSERT_BATCH_SIZE", 50))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_MB", 200)) * 1024 * 1024
+MAX_BULK_UPLOAD_SIZE = int(os.getenv("MAX_BULK_UPLOAD_MB", 2048)) * 1024 * 1024 # Total de una ingesta masiva
+DUPLICATE_DETAIL = "Este libro ya ha sido añadido."
+ANALYSIS_MODEL = 'gemini-1.5-flash-latest'
+ANALYSIS_PROMPT_VERSION = "1" # Incrementar al cambiar los prompts para invalidar la caché
+ANALYSIS_TEXT_LIMIT = 4000
+ANALYSIS_EXCERPT_CHARS = 4500 # Texto del principio del libro que se toma del artefacto extraído
+ANALYSIS_BATCH_SIZE = int(os.getenv("ANALYSIS_BATCH_SIZE", 5))
+COVER_MIN_SIZE = 300
+COVER_MAX_PAGES = int(os.getenv("COVER_MAX_PAGES", 10))
+COVER_FALLBACK_DPI = 50
+
+class UploadTooLargeError(ValueError):
+    """El archivo subido supera el tamaño máximo permitido."""
+
+_executor: ProcessPoolExecutor | None = None
+_analysis_model = None
+# Rutas y hashes que se están ingiriendo en este momento, para rechazar subidas simultáneas del mismo libro
+_in_flight: set[str] = set()
+
+def get_executor() -> ProcessPoolExecutor:
+    """Devuelve el pool de procesos compartido, creándolo en el primer uso."""
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=INGEST_WORKERS)
+    return _executor
+
+def shutdown_executor():
+    """Cierra el pool de procesos al apagar la aplicación."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+# --- Funciones de IA y Procesamiento ---
+def _get_analysis_model():
+    """Reutiliza una única instancia del modelo en lugar de crear una por llamada."""
+    global _analysis_model
+    if _analysis_model is None:
+        _analysis_model = genai.GenerativeModel(ANALYSIS_MODEL)
+    return _analysis_model
+
+def _analysis_key(text: str) -> str:
+    """Clave de caché: hash del extracto analizado, el modelo y la versión del prompt."""
+    payload = f"{ANALYSIS_PROMPT_VERSION}\0{ANALYSIS_MODEL}\0{text[:ANALYSIS_TEXT_LIMIT]}"
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def _load_cached_analyses(keys: list[str]) -> dict:
+    db = database.SessionLocal()
+    try:
+        return crud.get_cached_analyses(db, keys)
+    finally:
+        db.close()
+
+def _store_cached_analyses(entries: dict):
+    """Guarda en caché solo los análisis válidos (no los errores de la IA)."""
+    entries = {key: result for key, result in entries.items() if result.get("title") != "Error de IA"}
+    if not entries:
+        return
+    db = database.SessionLocal()
+    try:
+        crud.save_cached_analyses(db, entries)
+    finally:
+        db.close()
+
+def _parse_json_response(response_text: str):
+    match = response_text.strip()
+    if match.startswith("```json"):
+        match = match[7:]
+    if match.endswith("```"):
+        match = match[:-3]
+    return json.loads(match.strip())
+
+async def analyze_with_gemini(text: str) -> dict:
+    key = _analysis_key(text)
+    cached = _load_cached_analyses([key])
+    if key in cached:
+        return cached[key]
+
+    prompt = f"""
+    Eres un bibliotecario experto. Analiza el siguiente texto extraído de las primeras páginas de un libro.
+    Tu tarea es identificar el título, el autor y la categoría principal del libro.
+    Devuelve ÚNICAMENTE un objeto JSON con las claves "title", "author" y "category".
+    Si no puedes determinar un valor, usa "Desconocido".
+    Ejemplo: {{'title': 'El nombre del viento', 'author': 'Patrick Rothfuss', 'category': 'Fantasía'}}
+    Texto a analizar: --- {text[:ANALYSIS_TEXT_LIMIT]} ---
+    """
+    try:
+        response = await _get_analysis_model().generate_content_async(prompt)
+        print(f"DEBUG: Gemini raw response: {response.text}")
+        result = _parse_json_response(response.text)
+    except Exception as e:
+        print(f"Error al analizar con Gemini: {e}")
+        if 'response' in locals():
+            print(f"DEBUG: Gemini raw response on error: {response.text}")
+        return {"title": "Error de IA", "author": "Error de IA", "category": "Error de IA"}
+    _store_cached_analyses({key: result})
+    return result
+
+async def _analyze_group(texts: list[str]) -> list[dict]:
+    """Analiza varios libros con una sola petición; si la respuesta no es válida, los analiza uno a uno."""
+    if len(texts) == 1:
+        return [await analyze_with_gemini(texts[0])]
+
+    excerpts = "\n".join(f"--- Libro {i} ---\n{text[:ANALYSIS_TEXT_LIMIT]}\n" for i, text in enumerate(texts, start=1))
+    prompt = f"""
+    Eres un bibliotecario experto. A continuación tienes {len(texts)} textos, cada uno extraído de las primeras páginas de un libro distinto.
+    Para cada libro, identifica el título, el autor y la categoría principal.
+    Devuelve ÚNICAMENTE un array JSON con {len(texts)} objetos, en el mismo orden que los libros, cada uno con las claves "title", "author" y "category".
+    Si no puedes determinar un valor, usa "Desconocido".
+    Ejemplo: [{{'title': 'El nombre del viento', 'author': 'Patrick Rothfuss', 'category': 'Fantasía'}}]
+    {excerpts}
+    """
+    try:
+        response = await _get_analysis_model().generate_content_async(prompt)
+        results = _parse_json_response(response.text)
+        if not isinstance(results, list) or len(results) != len(texts) or not all(isinstance(r, dict) for r in results):
+            raise ValueError(f"se esperaban {len(texts)} objetos en la respuesta")
+    except Exception as e:
+        print(f"Error en el análisis por lotes con Gemini, se analizan por separado: {e}")
+        return list(await asyncio.gather(*(analyze_with_gemini(text) for text in texts)))
+    _store_cached_analyses({_analysis_key(text): result for text, result in zip(texts, results)})
+    return results
+
+async def analyze_batch_with_gemini(texts: list[str]) -> list[dict]:
+    """
+    Analiza varios libros agrupando sus extractos en peticiones de ANALYSIS_BATCH_SIZE libros.
+    Los textos ya analizados se sirven desde la caché sin llamar al modelo.
+    """
+    keys = [_analysis_key(text) for text in texts]
+    cached = _load_cached_analyses(keys)
+    results = [cached.get(key) for key in keys]
+    misses = [i for i, result in enumerate(results) if result is None]
+
+    semaphore = asyncio.Semaphore(ANALYSIS_CONCURRENCY)
+    async def run_group(indexes):
+        async with semaphore:
+            group_results = await _analyze_group([texts[i] for i in indexes])
+        for i, result in zip(indexes, group_results):
+            results[i] = result
+
+    groups = [misses[start:start + ANALYSIS_BATCH_SIZE] for start in range(0, len(misses), ANALYSIS_BATCH_SIZE)]
+    await asyncio.gather(*(run_group(group) for group in groups))
+    return results
+
+def _extract_pdf_cover(doc, cover_full_path: str) -> bool:
+    """
+    Busca una portada sin decodificar imágenes innecesarias: filtra por las dimensiones
+    declaradas en los metadatos, limita las páginas revisadas y, si no hay imagen válida,
+    renderiza la primera página a baja resolución.
+    """
+    for i in range(min(len(doc), COVER_MAX_PAGES)):
+        for img in doc.get_page_images(i):
+            xref, width, height = img[0], img[2], img[3]
+            if width <= COVER_MIN_SIZE or height <= COVER_MIN_SIZE:
+                continue
+            pix = fitz.Pixmap(doc, xref)
+            if pix.n - pix.alpha >= 4: # CMYK u otros espacios no soportados por PNG
+                pix = fitz.Pixmap(fitz.csRGB, pix)
+            pix.save(cover_full_path)
+            return True
+    if len(doc) > 0:
+        doc.load_page(0).get_pixmap(dpi=COVER_FALLBACK_DPI).save(cover_full_path)
+        return True
+    return False
+
+def process_pdf(file_path: str, static_dir: str) -> dict:
+    doc = fitz.open(file_path)
+    cover_path = None
+    cover_filename = f"cover_{os.path.basename(file_path)}.png"
+    started = time.perf_counter()
+    if _extract_pdf_cover(doc, os.path.join(static_dir, cover_filename)):
+        cover_path = f"{static_dir}/{cover_filename}"
+    cover_seconds = time.perf_counter() - started
+    print(f"Portada de {os.path.basename(file_path)} extraída en {cover_seconds * 1000:.1f} ms")
+    return {"cover_image_url": cover_path, "cover_seconds": cover_seconds}
+
+def process_epub(file_path: str, static_dir: str) -> dict:
+    """ Lógica de procesamiento de EPUB muy mejorada con fallbacks para la portada. """
+    book = epub.read_epub(file_path)
+    cover_path = None
+    cover_item = None
+
+    # Intento 1: Buscar la portada oficial en metadatos
+    cover_items = list(book.get_items_of_type(ebooklib.ITEM_COVER))
+    if cover_items:
+        cover_item = cover_items[0]
+
+    # Intento 2: Si no hay portada oficial, buscar por nombre de archivo "cover"
+    if not cover_item:
+        for item in book.get_items_of_type(ebooklib.ITEM_IMAGE):
+            if 'cover' in item.get_name().lower():
+                cover_item = item
+                break
+
+    # Si encontramos una portada por cualquiera de los métodos
+    if cover_item:
+        cover_filename = f"cover_{os.path.basename(file_path)}_{cover_item.get_name()}".replace('/', '_').replace('\\', '_')
+        cover_full_path = os.path.join(static_dir, cover_filename)
+        with open(cover_full_path, 'wb') as f: f.write(cover_item.get_content())
+        cover_path = f"{static_dir}/{cover_filename}"
+
+    return {"cover_image_url": cover_path}
+
+def process_book(file_path: str, static_dir: str) -> dict:
+    """Extrae la portada con el procesador adecuado según la extensión. Se ejecuta en el pool de procesos."""
+    file_ext = os.path.splitext(file_path)[1].lower()
+    if file_ext == ".pdf":
+        return process_pdf(file_path, static_dir)
+    if file_ext == ".epub":
+        return process_epub(file_path, static_dir)
+    raise ValueError("Tipo de archivo no soportado.")
+
+async def parse_book(file_path: str, static_dir: str, content_hash: str | None = None) -> dict:
+    """
+    Extrae en paralelo la portada y el texto completo del libro (guardado como artefacto para
+    el RAG y otras funciones). Devuelve los datos de process_book más el extracto para el análisis.
+    """
+    loop = asyncio.get_running_loop()
+    cover, pieces = await asyncio.gather(
+        loop.run_in_executor(get_executor(), process_book, file_path, static_dir),
+        extraction.load_text(file_path, content_hash, get_executor()),
+        return_exceptions=True,
+    )
+    if isinstance(pieces, Exception) or isinstance(cover, Exception):
+        if isinstance(cover, dict):
+            _remove_file(cover.get("cover_image_url"))
+        if not isinstance(pieces, Exception):
+            extraction.delete_artifact(content_hash)
+        raise pieces if isinstance(pieces, Exception) else cover
+    text = extraction.leading_text(pieces, ANALYSIS_EXCERPT_CHARS)
+    if len(text.strip()) < 100:
+        _remove_file(cover.get("cover_image_url"))
+        extraction.delete_artifact(content_hash)
+        raise ValueError("No se pudo extraer suficiente texto del libro para su análisis.")
+    return {**cover, "text": text}
+
+def save_upload(upload_file, file_path: str, max_size: int = MAX_UPLOAD_SIZE) -> str:
+    """
+    Vuelca el archivo subido a disco por bloques, sin cargarlo entero en memoria,
+    y devuelve el hash SHA-256 de su contenido calculado durante la escritura.
+    Si se supera max_size, borra lo escrito y lanza UploadTooLargeError.
+    """
+    digest = hashlib.sha256()
+    written = 0
+    with open(file_path, "wb") as buffer:
+        while chunk := upload_file.read(UPLOAD_CHUNK_SIZE):
+            written += len(chunk)
+            if written > max_size:
+                break
+            digest.update(chunk)
+            buffer.write(chunk)
+    if written > max_size:
+        os.remove(file_path)
+        raise UploadTooLargeError(f"El archivo supera el tamaño máximo permitido ({max_size // (1024 * 1024)} MB).")
+    return digest.hexdigest()
+
+def _remove_file(file_path: str):
+    if file_path and os.path.exists(file_path):
+        os.remove(file_path)
+
+def is_in_flight(key: str) -> bool:
+    return key in _in_flight
+
+def claim_path(file_path: str) -> bool:
+    """
+    Reserva la ruta de destino de una subida antes de empezar a escribirla. Devuelve False si
+    otra subida ya la está usando. run_ingest_job la libera al terminar.
+    """
+    if file_path in _in_flight:
+        return False
+    _in_flight.add(file_path)
+    return True
+
+def release_path(file_path: str):
+    _in_flight.discard(file_path)
+
+def claim_content_hash(db, content_hash: str) -> bool:
+    """
+    Reserva un hash de contenido para una ingesta. Devuelve False si el libro ya existe
+    en la base de datos o se está procesando en este momento.
+    """
+    if content_hash in _in_flight or crud.get_book_by_hash(db, content_hash):
+        return False
+    _in_flight.add(content_hash)
+    return True
+
+def release_content_hash(content_hash: str):
+    _in_flight.discard(content_hash)
+
+def _check_analysis(gemini_result: dict) -> dict:
+    """Puerta de calidad: valida el resultado de la IA y devuelve los metadatos del libro."""
+    title = gemini_result.get("title", "Desconocido")
+    author = gemini_result.get("author", "Desconocido")
+    if title == "Desconocido" and author == "Desconocido":
+        raise ValueError("La IA no pudo identificar el título ni el autor del libro. No se ha añadido.")
+    # Una categoría nula o vacía se guarda como "Desconocido" para que cuente en category_counts
+    return {"title": title, "author": author, "category": gemini_result.get("category") or "Desconocido"}
+
+# --- Trabajos de ingesta en segundo plano ---
+async def run_ingest_job(job_id: str, file_path: str, static_dir: str, content_hash: str):
+    """
+    Procesa un libro ya volcado a disco como trabajo en segundo plano, informando de cada etapa.
+    La ruta y el hash de contenido deben haberse reservado previamente con claim_path y claim_content_hash.
+    """
+    book_data = {}
+    try:
+        jobs.update_job(job_id, status="running", stage="parsing", progress=0.1)
+        book_data = await parse_book(file_path, static_dir, content_hash)
+
+        jobs.update_job(job_id, stage="analyzing", progress=0.5)
+        metadata = _check_analysis(await analyze_with_gemini(book_data["text"]))
+
+        jobs.update_job(job_id, stage="saving", progress=0.9)
+        db = database.SessionLocal()
+        try:
+            book = crud.create_book(db=db, cover_image_url=book_data.get("cover_image_url"), file_path=file_path, content_hash=content_hash, **metadata)
+            result = {"id": book.id, "cover_image_url": book.cover_image_url, "file_path": book.file_path, **metadata, "cover_seconds": book_data.get("cover_seconds")}
+        finally:
+            db.close()
+        jobs.complete_job(job_id, result=result)
+    except Exception as e:
+        _remove_file(file_path)
+        _remove_file(book_data.get("cover_image_url"))
+        extraction.delete_artifact(content_hash) # El texto extraído de un libro rechazado no se conserva
+        jobs.fail_job(job_id, str(e))
+    finally:
+        release_path(file_path)
+        release_content_hash(content_hash)
+
+# --- Pipeline de ingesta masiva ---
+def _accept_analysis(result: dict, book_data: dict, analysis: dict):
+    """Aplica la puerta de calidad al análisis y prepara la fila a insertar o descarta los archivos."""
+    try:
+        metadata = _check_analysis(analysis)
+    except ValueError as e:
+        _remove_file(result["book_path"])
+        _remove_file(book_data.get("cover_image_url"))
+        extraction.delete_artifact(result["content_hash"])
+        result.update(status="error", detail=str(e))
+        return
+    result["status"] = "analyzed"
+    result["book"] = {"cover_image_url": book_data.get("cover_image_url"), "file_path": result["book_path"], "content_hash": result["content_hash"], **metadata}
+
+async def _ingest_one(db, upload_file, file_path: str, static_dir: str, semaphore: asyncio.Semaphore | None) -> dict:
+    """
+    Procesa un único archivo a través de las etapas de volcado, parseo y análisis.
+    Sin semáforo, se detiene tras el parseo para que ingest_books analice los libros por lotes.
+    La ruta y el hash quedan reservados hasta que ingest_books termina la inserción.
+    """
+    result = {"filename": upload_file.filename, "status": "error", "detail": None, "book": None, "book_path": file_path, "content_hash": None}
+    book_data = {}
+    try:
+        # Etapa 1: volcado a disco en un hilo para no bloquear el bucle de eventos
+        content_hash = await asyncio.to_thread(save_upload, upload_file.file, file_path)
+        if not claim_content_hash(db, content_hash):
+            _remove_file(file_path)
+            result.update(status="duplicate", detail=DUPLICATE_DETAIL)
+            return result
+        result["content_hash"] = content_hash
+        # Etapa 2: extracción de texto y portada en el pool de procesos
+        book_data = await parse_book(file_path, static_dir, content_hash)
+        if semaphore is None:
+            result.update(status="parsed", book_data=book_data)
+            return result
+        # Etapa 3: análisis de metadatos con concurrencia limitada
+        async with semaphore:
+            analysis = await analyze_with_gemini(book_data["text"])
+    except Exception as e:
+        _remove_file(file_path)
+        _remove_file(book_data.get("cover_image_url"))
+        extraction.delete_artifact(result["content_hash"])
+        result["detail"] = str(e)
+        return result
+
+    _accept_analysis(result, book_data, analysis)
+    return result
+
+async def _analyze_parsed_in_batches(parsed: list):
+    """Etapa 3 en modo por lotes: varios libros por petición al modelo."""
+    analyses = await analyze_batch_with_gemini([r["book_data"]["text"] for r in parsed])
+    for result, analysis in zip(parsed, analyses):
+        _accept_analysis(result, result.pop("book_data"), analysis)
+
+def _insert_analyzed(db, analyzed: list):
+    """Etapa 4: inserción por lotes de los libros analizados correctamente."""
+    pending = [r for r in analyzed if r["status"] == "analyzed"]
+    for start in range(0, len(pending), INSERT_BATCH_SIZE):
+        batch = pending[start:start + INSERT_BATCH_SIZE]
+        try:
+            created = crud.create_books(db, [r["book"] for r in batch])
+        except Exception as e:
+            db.rollback()
+            for r in batch:
+                _remove_file(r["book"]["file_path"])
+                _remove_file(r["book"]["cover_image_url"])
+                extraction.delete_artifact(r["book"]["content_hash"])
+                r.update(status="error", detail=f"Error al guardar en la base de datos: {e}", book=None)
+            continue
+        for r, book in zip(batch, created):
+            r.update(status="created", book=book)
+
+async def ingest_books(db, upload_files: list, static_dir: str, batch_analysis: bool = False) -> dict:
+    """
+    Ingesta varios libros como un pipeline por etapas: volcado a disco, parseo en un pool
+    de procesos, análisis con concurrencia limitada e inserción por lotes en la base de datos.
+    Con batch_analysis, los extractos se envían al modelo de ANALYSIS_BATCH_SIZE en ANALYSIS_BATCH_SIZE.
+    """
+    started = time.perf_counter()
+    os.makedirs(BOOKS_DIR, exist_ok=True)
+    semaphore = None if batch_analysis else asyncio.Semaphore(ANALYSIS_CONCURRENCY)
+
+    results = []
+    tasks = {}
+    seen_paths = set()
+    for upload_file in upload_files:
+        file_path = os.path.abspath(os.path.join(BOOKS_DIR, upload_file.filename))
+        file_ext = os.path.splitext(upload_file.filename)[1].lower()
+        result = {"filename": upload_file.filename, "status": "error", "detail": None, "book": None}
+        if file_ext not in SUPPORTED_EXTENSIONS:
+            result["detail"] = "Tipo de archivo no soportado."
+        elif file_path in seen_paths or is_in_flight(file_path) or crud.get_book_by_path(db, file_path):
+            result["status"] = "duplicate"
+            result["detail"] = DUPLICATE_DETAIL
+        else:
+            seen_paths.add(file_path)
+            tasks[len(results)] = _ingest_one(db, upload_file, file_path, static_dir, semaphore)
+        results.append(result)
+
+    _in_flight.update(seen_paths)
+    try:
+        analyzed = await asyncio.gather(*tasks.values())
+        for index, result in zip(tasks.keys(), analyzed):
+            results[index] = result
+        if batch_analysis:
+            await _analyze_parsed_in_batches([r for r in analyzed if r["status"] == "parsed"])
+        _insert_analyzed(db, analyzed)
+    finally:
+        _in_flight.difference_update(seen_paths)
+        for result in results:
+            result.pop("book_path", None)
+            if result.get("content_hash"):
+                release_content_hash(result.pop("content_hash"))
+
+    elapsed = time.perf_counter() - started
+    created_count = sum(1 for r in results if r["status"] == "created")
+    return {
+        "results": results,
+        "total": len(results),
+        "created": created_count,
+        "failed": len(results) - created_count,
+        "elapsed_seconds": round(elapsed, 3),
+        "books_per_second": round(created_count / elapsed, 3) if elapsed > 0 else 0.0,
+    }
@@ -0,0 +1,81 @@
+import asyncio
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# Registro en memoria de trabajos en segundo plano (ingesta, conversiones, ...)
+# Los trabajos terminados se conservan JOB_TTL_SECONDS para que el cliente pueda consultar el
+# resultado, y como mucho MAX_FINISHED_JOBS; después se eliminan.
+JOB_TTL_SECONDS = int(os.getenv("JOB_TTL_SECONDS", 3600))
+MAX_FINISHED_JOBS = int(os.getenv("MAX_FINISHED_JOBS", 10000))
+FINISHED_STATUSES = ("completed", "failed")
+
+_jobs: dict[str, dict] = {}
+# Trabajos terminados en orden de finalización (id -> instante)
+_finished: OrderedDict[str, float] = OrderedDict()
+_lock = threading.Lock()
+# Referencias a las tareas en curso para que el recolector de basura no las cancele
+_tasks: set[asyncio.Task] = set()
+
+def create_job(kind: str, **fields) -> dict:
+    """Registra un nuevo trabajo en estado 'pending' y lo devuelve."""
+    now = time.time()
+    job = {
+        "id": str(uuid.uuid4()),
+        "kind": kind,
+        "status": "pending",
+        "stage": "queued",
+        "progress": 0.0,
+        "detail": None,
+        "result": None,
+        "created_at": now,
+        "updated_at": now,
+    }
+    job.update(fields)
+    with _lock:
+        _prune(now)
+        _jobs[job["id"]] = job
+    return dict(job)
+
+def _prune(now: float):
+    """Elimina los trabajos terminados que han caducado o que exceden el máximo. Requiere _lock."""
+    while _finished:
+        job_id, finished_at = next(iter(_finished.items()))
+        if finished_at > now - JOB_TTL_SECONDS and len(_finished) <= MAX_FINISHED_JOBS:
+            break
+        _finished.popitem(last=False)
+        _jobs.pop(job_id, None)
+
+def update_job(job_id: str, **fields) -> dict | None:
+    """Actualiza los campos de un trabajo existente."""
+    with _lock:
+        job = _jobs.get(job_id)
+        if job is None:
+            return None
+        job.update(fields)
+        job["updated_at"] = time.time()
+        if job["status"] in FINISHED_STATUSES:
+            _finished[job_id] = job["updated_at"]
+            _finished.move_to_end(job_id)
+        return dict(job)
+
+def get_job(job_id: str) -> dict | None:
+    """Obtiene una copia del estado actual de un trabajo."""
+    with _lock:
+        job = _jobs.get(job_id)
+        return dict(job) if job else None
+
+def fail_job(job_id: str, detail: str) -> dict | None:
+    return update_job(job_id, status="failed", detail=detail)
+
+def complete_job(job_id: str, result=None) -> dict | None:
+    return update_job(job_id, status="completed", stage="done", progress=1.0, result=result)
+
+def run_in_background(coro) -> asyncio.Task:
+    """Lanza una corrutina como tarea de fondo en el bucle de eventos actual."""
+    task = asyncio.create_task(coro)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
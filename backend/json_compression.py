@@ -0,0 +1,55 @@
+import gzip
+
+# --- Compresión de las respuestas JSON ---
+# Solo se comprimen con gzip las respuestas application/json de al menos minimum_size bytes que
+# llegan en un único bloque. Las descargas de libros, los estáticos, los PDF convertidos y los
+# eventos SSE pasan sin tocar: ya están comprimidos o deben mantener Content-Length y rangos.
+COMPRESSION_LEVEL = 6
+
+class JSONCompressionMiddleware:
+    """Middleware ASGI que comprime con gzip las respuestas JSON cuando el cliente lo acepta."""
+
+    def __init__(self, app, minimum_size: int = 1024):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope.get("headers") or [])
+        if b"gzip" not in headers.get(b"accept-encoding", b""):
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        decided = False
+
+        async def compressing_send(message):
+            nonlocal start_message, decided
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if decided or message["type"] != "http.response.body":
+                await send(message)
+                return
+            decided = True
+            body = message.get("body", b"")
+            response_headers = [(k, v) for k, v in start_message.get("headers", []) if k.lower() != b"content-length"]
+            header_map = {k.lower(): v for k, v in response_headers}
+            content_type = header_map.get(b"content-type", b"")
+            if (content_type.startswith(b"application/json") and b"content-encoding" not in header_map
+                    and not message.get("more_body", False) and len(body) >= self.minimum_size):
+                body = gzip.compress(body, compresslevel=COMPRESSION_LEVEL)
+                response_headers += [(b"content-encoding", b"gzip"), (b"vary", b"Accept-Encoding"),
+                                     (b"content-length", str(len(body)).encode())]
+                await send({**start_message, "headers": response_headers})
+                await send({"type": "http.response.body", "body": body})
+                return
+            await send(start_message)
+            await send(message)
+
+        await self.app(scope, receive, compressing_send)
+        if start_message is not None and not decided:
+            # Respuesta sin cuerpo (p. ej. 304): se envía la cabecera tal cual
+            await send(start_message)
@@ -0,0 +1,179 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+
+# BM25 index over the same chunks stored in the vector collection, persisted in SQLite with FTS5
+# (the same approach as the catalog search). Ranking, the book scope and the result limit all run
+# inside SQLite, so a query does not scale with the number of books in Python.
+LEXICAL_INDEX_PATH = os.getenv("RAG_LEXICAL_INDEX_PATH", "lexical_index.sqlite3")
+# Frequent words that match most chunks without telling them apart; dropped from queries
+STOPWORDS = frozenset("""
+    a al algo con como cual de del el ella ellas ellos en entre era es esa ese eso esta este esto fue
+    ha hay la las le les lo los mas me mi muy no nos o para pero por que se si sin sobre su sus te
+    tu un una uno unos unas y ya yo
+    an and are as at be by for from in is it of on or that the this to was with
+""".split())
+
+# Terms present in more than this fraction of the chunks are dropped too (the rarest term is always kept)
+MAX_TERM_DOC_FRACTION = float(os.getenv("RAG_LEXICAL_MAX_TERM_FRACTION", 0.2))
+
+_TOKEN = re.compile(r"\w+")
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS lexical_chunks (
+        id INTEGER PRIMARY KEY,
+        book_id TEXT NOT NULL,
+        chunk_index INTEGER NOT NULL,
+        document TEXT NOT NULL,
+        UNIQUE (book_id, chunk_index)
+    );
+    CREATE VIRTUAL TABLE IF NOT EXISTS lexical_fts USING fts5(
+        document,
+        content='lexical_chunks', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    );
+    CREATE TRIGGER IF NOT EXISTS lexical_chunks_ai AFTER INSERT ON lexical_chunks BEGIN
+        INSERT INTO lexical_fts(rowid, document) VALUES (new.id, new.document);
+    END;
+    CREATE TRIGGER IF NOT EXISTS lexical_chunks_ad AFTER DELETE ON lexical_chunks BEGIN
+        INSERT INTO lexical_fts(lexical_fts, rowid, document) VALUES ('delete', old.id, old.document);
+    END;
+    CREATE VIRTUAL TABLE IF NOT EXISTS lexical_vocab USING fts5vocab(lexical_fts, 'row');
+    CREATE TABLE IF NOT EXISTS lexical_books (
+        book_id TEXT PRIMARY KEY,
+        chunk_count INTEGER NOT NULL
+    );
+"""
+
+# One connection per thread: in WAL mode readers run concurrently; writes are serialized by _write_lock
+_local = threading.local()
+_write_lock = threading.Lock()
+_schema_ready = False
+# Ids of the indexed books, loaded once and kept in sync by add_chunks/delete_book
+_indexed_books: set[str] | None = None
+
+def _get_connection() -> sqlite3.Connection:
+    """Returns this thread's connection to the index database, creating the schema on first use."""
+    global _schema_ready
+    connection = getattr(_local, "connection", None)
+    if connection is None:
+        connection = sqlite3.connect(LEXICAL_INDEX_PATH, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        if not _schema_ready:
+            with _write_lock:
+                connection.executescript(SCHEMA)
+                _schema_ready = True
+        _local.connection = connection
+    return connection
+
+def tokenize(text: str) -> list[str]:
+    """Lowercases the text, strips diacritics and splits it into word tokens."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return _TOKEN.findall(text)
+
+def _match_expression(connection: sqlite3.Connection, query: str) -> str | None:
+    """
+    FTS5 expression matching any of the query's selective terms, or None. Stopwords and terms
+    found in most chunks barely change the ranking but make FTS5 read their whole posting lists.
+    """
+    terms = list(dict.fromkeys(term for term in tokenize(query) if term not in STOPWORDS))
+    if not terms:
+        return None
+    placeholders = ",".join("?" * len(terms))
+    doc_counts = dict(connection.execute(f"SELECT term, doc FROM lexical_vocab WHERE term IN ({placeholders})", terms))
+    terms = [term for term in terms if term in doc_counts]
+    if not terms:
+        return None
+    total_chunks = connection.execute("SELECT COALESCE(SUM(chunk_count), 0) FROM lexical_books").fetchone()[0]
+    selective = [term for term in terms if doc_counts[term] <= MAX_TERM_DOC_FRACTION * total_chunks]
+    if not selective:
+        selective = [min(terms, key=doc_counts.get)]
+    return " OR ".join(f'"{term}"' for term in selective)
+
+def _indexed() -> set[str]:
+    global _indexed_books
+    if _indexed_books is None:
+        _indexed_books = {row[0] for row in _get_connection().execute("SELECT book_id FROM lexical_books")}
+    return _indexed_books
+
+def add_chunks(book_id: str, chunks: list[str], start_index: int = 0, chunk_indexes: list[int] | None = None):
+    """
+    Indexes a book's chunks, replacing any previous version of the same chunk indexes.
+    Chunks are numbered from start_index unless explicit chunk_indexes are given.
+    """
+    if chunk_indexes is None:
+        chunk_indexes = range(start_index, start_index + len(chunks))
+    rows = [(book_id, chunk_index, chunk) for chunk_index, chunk in zip(chunk_indexes, chunks) if chunk.strip()]
+    connection = _get_connection()
+    with _write_lock:
+        connection.executemany("DELETE FROM lexical_chunks WHERE book_id = ? AND chunk_index = ?",
+                               [(book_id, chunk_index) for _, chunk_index, _ in rows])
+        connection.executemany("INSERT INTO lexical_chunks (book_id, chunk_index, document) VALUES (?, ?, ?)", rows)
+        connection.execute(
+            "INSERT OR REPLACE INTO lexical_books (book_id, chunk_count) "
+            "SELECT ?, COUNT(*) FROM lexical_chunks WHERE book_id = ?", (book_id, book_id)
+        )
+        connection.commit()
+        _indexed().add(book_id)
+
+def missing_books(book_ids: list[str]) -> list[str]:
+    """Returns the book ids that have no lexical index yet."""
+    indexed = _indexed()
+    return [book_id for book_id in book_ids if book_id not in indexed]
+
+def search(book_ids: list[str] | None, query: str, n_results: int) -> list[tuple[str, int, str]]:
+    """
+    Ranks chunks against the query with FTS5's bm25(), restricted to book_ids (None: every book).
+    Returns up to n_results (book_id, chunk_index, document), best first.
+    """
+    if book_ids == []:
+        return []
+    connection = _get_connection()
+    match = _match_expression(connection, query)
+    if match is None:
+        return []
+    if book_ids is None:
+        # Whole library: FTS5 sorts by rank and stops at the limit without a join per match
+        rows = connection.execute("""
+            SELECT c.book_id, c.chunk_index, c.document
+            FROM (SELECT rowid, rank FROM lexical_fts WHERE lexical_fts MATCH ? ORDER BY rank LIMIT ?) AS ranked
+            JOIN lexical_chunks AS c ON c.id = ranked.rowid
+            ORDER BY ranked.rank""", (match, n_results))
+    else:
+        # The scope travels as a single JSON parameter, whatever its size
+        rows = connection.execute("""
+            SELECT c.book_id, c.chunk_index, c.document
+            FROM lexical_fts JOIN lexical_chunks AS c ON c.id = lexical_fts.rowid
+            WHERE lexical_fts MATCH ? AND c.book_id IN (SELECT value FROM json_each(?))
+            ORDER BY lexical_fts.rank LIMIT ?""", (match, json.dumps(book_ids), n_results))
+    return [(book_id, chunk_index, document) for book_id, chunk_index, document in rows]
+
+def delete_book(book_id: str):
+    """Removes a book from the index."""
+    connection = _get_connection()
+    with _write_lock:
+        connection.execute("DELETE FROM lexical_chunks WHERE book_id = ?", (book_id,))
+        connection.execute("DELETE FROM lexical_books WHERE book_id = ?", (book_id,))
+        connection.commit()
+        _indexed().discard(book_id)
+
+def book_ids() -> set[str]:
+    """Ids of every book in the index."""
+    with _write_lock:
+        return set(_indexed())
+
+def size_bytes() -> int:
+    """Size of the index database on disk, including its write-ahead log."""
+    return sum(os.path.getsize(path) for path in (LEXICAL_INDEX_PATH, f"{LEXICAL_INDEX_PATH}-wal") if os.path.exists(path))
+
+def vacuum():
+    """Merges the FTS segments and rewrites the database file so the space of deleted books is returned."""
+    connection = _get_connection()
+    with _write_lock:
+        connection.execute("INSERT INTO lexical_fts(lexical_fts) VALUES ('optimize')")
+        connection.commit()
+        connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        connection.execute("VACUUM")
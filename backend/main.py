@@ -1,22 +1,22 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, Response
+from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, Response, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from sqlalchemy.orm import Session
-import shutil
+import asyncio
 import os
-import io
-import fitz
-import ebooklib
-from ebooklib import epub
-from bs4 import BeautifulSoup
+import json
 import google.generativeai as genai
 from dotenv import load_dotenv
-import json
+from email.utils import formatdate, parsedate_to_datetime
 from typing import List
 
 import crud, models, database, schemas
+import converter, ingest, jobs
+from json_compression import JSONCompressionMiddleware
+from upload_limit import MULTIPART_OVERHEAD, UploadSizeLimitMiddleware
 import rag # Import the new RAG module
+import rag_indexing
 import uuid # For generating unique book IDs
 
 # --- Configuración Inicial ---
@@ -27,86 +27,6 @@ if not API_KEY:
 genai.configure(api_key=API_KEY)
 models.Base.metadata.create_all(bind=database.engine)
 
-# --- Funciones de IA y Procesamiento ---
-async def analyze_with_gemini(text: str) -> dict:
-    model = genai.GenerativeModel('gemini-1.5-flash-latest')
-    prompt = f"""
-    Eres un bibliotecario experto. Analiza el siguiente texto extraído de las primeras páginas de un libro.
-    Tu tarea es identificar el título, el autor y la categoría principal del libro.
-    Devuelve ÚNICAMENTE un objeto JSON con las claves "title", "author" y "category".
-    Si no puedes determinar un valor, usa "Desconocido".
-    Ejemplo: {{'title': 'El nombre del viento', 'author': 'Patrick Rothfuss', 'category': 'Fantasía'}}
-    Texto a analizar: --- {text[:4000]} ---
-    """
-    try:
-        response = await model.generate_content_async(prompt)
-        print(f"DEBUG: Gemini raw response: {response.text}")
-        match = response.text.strip()
-        if match.startswith("```json"):
-            match = match[7:]
-        if match.endswith("```"):
-            match = match[:-3]
-        return json.loads(match.strip())
-    except Exception as e:
-        print(f"Error al analizar con Gemini: {e}")
-        if 'response' in locals():
-            print(f"DEBUG: Gemini raw response on error: {response.text}")
-        return {"title": "Error de IA", "author": "Error de IA", "category": "Error de IA"}
-
-def process_pdf(file_path: str, static_dir: str) -> dict:
-    doc = fitz.open(file_path)
-    text = ""
-    for i in range(min(len(doc), 5)): text += doc.load_page(i).get_text("text", sort=True)
-    cover_path = None
-    for i in range(len(doc)):
-        for img in doc.get_page_images(i):
-            xref = img[0]
-            pix = fitz.Pixmap(doc, xref)
-            if pix.width > 300 and pix.height > 300:
-                cover_filename = f"cover_{os.path.basename(file_path)}.png"
-                cover_full_path = os.path.join(static_dir, cover_filename)
-                pix.save(cover_full_path)
-                cover_path = f"{static_dir}/{cover_filename}"
-                break
-        if cover_path: break
-    return {"text": text, "cover_image_url": cover_path}
-
-def process_epub(file_path: str, static_dir: str) -> dict:
-    """ Lógica de procesamiento de EPUB muy mejorada con fallbacks para la portada. """
-    book = epub.read_epub(file_path)
-    text = ""
-    for item in book.get_items_of_type(ebooklib.ITEM_DOCUMENT):
-        soup = BeautifulSoup(item.get_content(), 'html.parser')
-        text += soup.get_text(separator=' ') + "\n"
-        if len(text) > 4500: break
-    
-    if len(text.strip()) < 100:
-        raise HTTPException(status_code=422, detail="No se pudo extraer suficiente texto del EPUB para su análisis.")
-
-    cover_path = None
-    cover_item = None
-
-    # Intento 1: Buscar la portada oficial en metadatos
-    cover_items = list(book.get_items_of_type(ebooklib.ITEM_COVER))
-    if cover_items:
-        cover_item = cover_items[0]
-    
-    # Intento 2: Si no hay portada oficial, buscar por nombre de archivo "cover"
-    if not cover_item:
-        for item in book.get_items_of_type(ebooklib.ITEM_IMAGE):
-            if 'cover' in item.get_name().lower():
-                cover_item = item
-                break
-
-    # Si encontramos una portada por cualquiera de los métodos
-    if cover_item:
-        cover_filename = f"cover_{os.path.basename(file_path)}_{cover_item.get_name()}".replace('/', '_').replace('\\', '_')
-        cover_full_path = os.path.join(static_dir, cover_filename)
-        with open(cover_full_path, 'wb') as f: f.write(cover_item.get_content())
-        cover_path = f"{static_dir}/{cover_filename}"
-
-    return {"text": text, "cover_image_url": cover_path}
-
 # --- Configuración de la App FastAPI ---
 app = FastAPI()
 STATIC_COVERS_DIR = "static/covers"
@@ -115,6 +35,14 @@ STATIC_TEMP_DIR = "temp_books"
 os.makedirs(STATIC_TEMP_DIR, exist_ok=True)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 app.mount("/temp_books", StaticFiles(directory=STATIC_TEMP_DIR), name="temp_books")
+# Límite de tamaño aplicado mientras llega el cuerpo, antes de que Starlette lo vuelque a disco
+# (se añade antes que CORS para que el 413 lleve sus cabeceras)
+app.add_middleware(UploadSizeLimitMiddleware, limits={
+    "/upload-book/": ingest.MAX_UPLOAD_SIZE + MULTIPART_OVERHEAD,
+    "/upload-books/": ingest.MAX_BULK_UPLOAD_SIZE + MULTIPART_OVERHEAD,
+    "/rag/upload-book/": ingest.MAX_UPLOAD_SIZE + MULTIPART_OVERHEAD,
+    "/tools/convert-epub-to-pdf": ingest.MAX_UPLOAD_SIZE + MULTIPART_OVERHEAD,
+})
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000"],
@@ -122,88 +50,162 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Compresión gzip solo de las respuestas JSON grandes (no de descargas, estáticos ni SSE)
+COMPRESSION_MIN_SIZE = 1024
+app.add_middleware(JSONCompressionMiddleware, minimum_size=COMPRESSION_MIN_SIZE)
+
+@app.on_event("startup")
+async def resume_rag_index_jobs():
+    rag_indexing.resume_unfinished_jobs()
+
+@app.on_event("shutdown")
+def shutdown_ingest_pool():
+    ingest.shutdown_executor()
 
 def get_db():
     db = database.SessionLocal()
     try: yield db
     finally: db.close()
 
+async def save_upload_or_413(upload: UploadFile, file_path: str) -> str:
+    """Vuelca la subida a disco por bloques en un hilo, respondiendo 413 si supera el tamaño máximo."""
+    try:
+        return await asyncio.to_thread(ingest.save_upload, upload.file, file_path)
+    except ingest.UploadTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+def _is_not_modified(request: Request, etag: str, updated_at: float) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag.removeprefix("W/") in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(updated_at) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def library_cache(request: Request, response: Response, db: Session = Depends(get_db)):
+    """
+    Caché HTTP condicional para los endpoints del catálogo: ETag y Last-Modified se derivan de la
+    versión de la biblioteca, que cambia con cada escritura. Si el cliente ya tiene esa versión, 304.
+    """
+    version, updated_at = crud.get_library_version(db)
+    headers = {
+        "ETag": f'W/"biblioteca-{version}"',
+        "Last-Modified": formatdate(updated_at, usegmt=True),
+        "Cache-Control": "no-cache",
+    }
+    if _is_not_modified(request, headers["ETag"], updated_at):
+        raise HTTPException(status_code=304, headers=headers)
+    response.headers.update(headers)
+
 # --- Rutas de la API ---
-@app.post("/upload-book/", response_model=schemas.Book)
+@app.post("/upload-book/", response_model=schemas.Job, status_code=202)
 async def upload_book(db: Session = Depends(get_db), book_file: UploadFile = File(...)):
-    books_dir = "books"
-    os.makedirs(books_dir, exist_ok=True)
-    file_path = os.path.abspath(os.path.join(books_dir, book_file.filename))
-
-    if crud.get_book_by_path(db, file_path):
-        raise HTTPException(status_code=409, detail="Este libro ya ha sido añadido.")
-
-    with open(file_path, "wb") as buffer: shutil.copyfileobj(book_file.file, buffer)
+    """Guarda el libro y lanza su procesamiento como trabajo en segundo plano. Devuelve el trabajo creado."""
+    os.makedirs(ingest.BOOKS_DIR, exist_ok=True)
+    file_path = os.path.abspath(os.path.join(ingest.BOOKS_DIR, book_file.filename))
 
     file_ext = os.path.splitext(book_file.filename)[1].lower()
-    try:
-        if file_ext == ".pdf": book_data = process_pdf(file_path, STATIC_COVERS_DIR)
-        elif file_ext == ".epub": book_data = process_epub(file_path, STATIC_COVERS_DIR)
-        else: raise HTTPException(status_code=400, detail="Tipo de archivo no soportado.")
-    except HTTPException as e:
-        os.remove(file_path) # Limpiar el archivo subido si el procesamiento falla
-        raise e
-
-    gemini_result = await analyze_with_gemini(book_data["text"])
-    
-    # --- Puerta de Calidad ---
-    title = gemini_result.get("title", "Desconocido")
-    author = gemini_result.get("author", "Desconocido")
-
-    if title == "Desconocido" and author == "Desconocido":
-        os.remove(file_path) # Borrar el archivo que no se pudo analizar
-        raise HTTPException(status_code=422, detail="La IA no pudo identificar el título ni el autor del libro. No se ha añadido.")
-
-    return crud.create_book(
-        db=db, 
-        title=title, 
-        author=author, 
-        category=gemini_result.get("category", "Desconocido"), 
-        cover_image_url=book_data.get("cover_image_url"), 
-        file_path=file_path
-    )
+    if file_ext not in ingest.SUPPORTED_EXTENSIONS:
+        raise HTTPException(status_code=400, detail="Tipo de archivo no soportado.")
 
-@app.get("/books/", response_model=List[schemas.Book])
-def read_books(category: str | None = None, search: str | None = None, author: str | None = None, db: Session = Depends(get_db)):
-    return crud.get_books(db, category=category, search=search, author=author)
+    # La ruta se reserva antes de escribir, para que dos subidas con el mismo nombre no pisen el archivo
+    if crud.get_book_by_path(db, file_path) or not ingest.claim_path(file_path):
+        raise HTTPException(status_code=409, detail=ingest.DUPLICATE_DETAIL)
+    try:
+        content_hash = await save_upload_or_413(book_file, file_path)
+
+        # El mismo contenido subido con otro nombre se rechaza antes de parsear o llamar a la IA
+        if not ingest.claim_content_hash(db, content_hash):
+            os.remove(file_path)
+            raise HTTPException(status_code=409, detail=ingest.DUPLICATE_DETAIL)
+    except BaseException:
+        ingest.release_path(file_path)
+        raise
+
+    job = jobs.create_job("ingest", filename=book_file.filename)
+    jobs.run_in_background(ingest.run_ingest_job(job["id"], file_path, STATIC_COVERS_DIR, content_hash))
+    return job
+
+@app.post("/upload-books/", response_model=schemas.BulkUploadResponse)
+async def upload_books(batch_analysis: bool = False, db: Session = Depends(get_db), book_files: List[UploadFile] = File(...)):
+    """Ingesta masiva: procesa varios libros en paralelo y devuelve el resultado por archivo."""
+    return await ingest.ingest_books(db, book_files, STATIC_COVERS_DIR, batch_analysis=batch_analysis)
+
+@app.get("/jobs/{job_id}", response_model=schemas.Job)
+def read_job(job_id: str):
+    """Consulta la etapa y el progreso de un trabajo en segundo plano."""
+    job = jobs.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado.")
+    return job
+
+@app.get("/books/", response_model=schemas.BookPage, response_model_exclude_unset=True, dependencies=[Depends(library_cache)])
+def read_books(category: str | None = None, search: str | None = None, author: str | None = None,
+               cursor: str | None = None, limit: int = Query(50, ge=1, le=200), fields: str | None = None,
+               db: Session = Depends(get_db)):
+    """
+    Lista los libros por páginas (paginación por clave sobre el id). Para la página siguiente,
+    se pasa el next_cursor recibido. fields=id,title,... limita las columnas devueltas.
+    """
+    field_list = None
+    if fields:
+        field_list = [f.strip() for f in fields.split(",") if f.strip()]
+        invalid = [f for f in field_list if f not in crud.BOOK_FIELDS]
+        if invalid:
+            raise HTTPException(status_code=400, detail=f"Campos no válidos: {', '.join(invalid)}.")
+    try:
+        items, next_cursor = crud.get_books_page(db, category=category, search=search, author=author,
+                                                 cursor=cursor, limit=limit, fields=field_list)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"items": items, "next_cursor": next_cursor}
 
-@app.get("/books/count", response_model=int)
+@app.get("/books/count", response_model=int, dependencies=[Depends(library_cache)])
 def get_books_count(db: Session = Depends(get_db)):
     """Obtiene el número total de libros en la biblioteca."""
     return crud.get_books_count(db)
 
-@app.get("/books/search/", response_model=List[schemas.Book])
+@app.get("/books/search/", response_model=List[schemas.Book], dependencies=[Depends(library_cache)])
 def search_books(title: str, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
     """Busca libros por un título parcial, con opciones de paginación."""
     books = crud.get_books_by_partial_title(db, title=title, skip=skip, limit=limit)
     return books
 
-@app.get("/categories/", response_model=List[str])
+@app.get("/categories/", response_model=List[str], dependencies=[Depends(library_cache)])
 def read_categories(db: Session = Depends(get_db)):
     return crud.get_categories(db)
 
+@app.get("/categories/counts", response_model=List[schemas.CategoryCount], dependencies=[Depends(library_cache)])
+def read_category_counts(db: Session = Depends(get_db)):
+    """Obtiene las categorías junto con su número de libros."""
+    return crud.get_category_counts(db)
+
 @app.delete("/books/{book_id}")
 def delete_single_book(book_id: int, db: Session = Depends(get_db)):
+    """Elimina el libro, sus archivos y su índice RAG (vectores incluidos)."""
     book = crud.delete_book(db, book_id=book_id)
     if not book:
         raise HTTPException(status_code=404, detail="Libro no encontrado.")
+    rag.delete_book_index(str(book.id))
     return {"message": f"Libro '{book.title}' eliminado con éxito."}
 
 @app.delete("/categories/{category_name}")
 def delete_category_and_books(category_name: str, db: Session = Depends(get_db)):
-    deleted_count = crud.delete_books_by_category(db, category=category_name)
-    if deleted_count == 0:
+    deleted_ids = crud.delete_books_by_category(db, category=category_name)
+    if not deleted_ids:
         raise HTTPException(status_code=404, detail=f"Categoría '{category_name}' no encontrada o ya está vacía.")
-    return {"message": f"Categoría '{category_name}' y sus {deleted_count} libros han sido eliminados."}
+    for deleted_id in deleted_ids:
+        rag.delete_book_index(str(deleted_id))
+    return {"message": f"Categoría '{category_name}' y sus {len(deleted_ids)} libros han sido eliminados."}
 
 @app.get("/books/download/{book_id}")
 def download_book(book_id: int, db: Session = Depends(get_db)):
-    book = db.query(models.Book).filter(models.Book.id == book_id).first()
+    book = crud.get_book(db, book_id)
     if not book:
         raise HTTPException(status_code=404, detail="Libro no encontrado.")
     if not os.path.exists(book.file_path):
@@ -227,200 +229,155 @@ def download_book(book_id: int, db: Session = Depends(get_db)):
             content_disposition_type='attachment'
         )
 
-@app.post("/tools/convert-epub-to-pdf", response_model=schemas.ConversionResponse)
+@app.post("/tools/convert-epub-to-pdf", response_model=schemas.Job, status_code=202)
 async def convert_epub_to_pdf(file: UploadFile = File(...)):
-
+    """
+    Lanza la conversión como trabajo en segundo plano; el resultado (download_url) se consulta en
+    /jobs/{id}. Si ese EPUB ya se había convertido, el trabajo se devuelve ya completado.
+    """
     if not file.filename.lower().endswith('.epub'):
         raise HTTPException(status_code=400, detail="El archivo debe ser un EPUB.")
 
-    epub_content = await file.read()
+    epub_path = os.path.join(STATIC_TEMP_DIR, f"upload_{uuid.uuid4()}.epub")
+    content_hash = await save_upload_or_413(file, epub_path)
+    return converter.start_conversion(epub_path, content_hash, file.filename, STATIC_TEMP_DIR, "/temp_books")
 
-    try:
-        import tempfile
-        import zipfile
-        import pathlib
-        from weasyprint import HTML, CSS
-        from bs4 import BeautifulSoup
-        import uuid
-
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # 1. Extraer el EPUB a una carpeta temporal
-            with zipfile.ZipFile(io.BytesIO(epub_content), 'r') as zip_ref:
-                zip_ref.extractall(temp_dir)
-
-            # 2. Encontrar el archivo .opf (el "manifiesto" del libro)
-            opf_path = next(pathlib.Path(temp_dir).rglob('*.opf'), None)
-            if not opf_path:
-                raise Exception("No se pudo encontrar el archivo .opf en el EPUB.")
-            content_root = opf_path.parent
-
-            # 3. Leer y analizar el manifiesto .opf en modo binario para autodetectar codificación
-            with open(opf_path, 'rb') as f:
-                opf_soup = BeautifulSoup(f, 'lxml-xml')
-
-            # 4. Crear una página de portada si se encuentra
-            html_docs = []
-            cover_meta = opf_soup.find('meta', {'name': 'cover'})
-            if cover_meta:
-                cover_id = cover_meta.get('content')
-                cover_item = opf_soup.find('item', {'id': cover_id})
-                if cover_item:
-                    cover_href = cover_item.get('href')
-                    cover_path = content_root / cover_href
-                    if cover_path.exists():
-                        cover_html_string = f"<html><body style='text-align: center; margin: 0; padding: 0;'><img src='{cover_path.as_uri()}' style='width: 100%; height: 100%; object-fit: contain;'/></body></html>"
-                        html_docs.append(HTML(string=cover_html_string))
-
-            # 5. Encontrar y leer todos los archivos CSS
-            stylesheets = []
-            css_items = opf_soup.find_all('item', {'media-type': 'text/css'})
-            for css_item in css_items:
-                css_href = css_item.get('href')
-                if css_href:
-                    css_path = content_root / css_href
-                    if css_path.exists():
-                        stylesheets.append(CSS(filename=css_path))
-
-            # 6. Encontrar el orden de lectura (spine) y añadir los capítulos
-            spine_ids = [item.get('idref') for item in opf_soup.find('spine').find_all('itemref')]
-            html_paths_map = {item['id']: item['href'] for item in opf_soup.find_all('item', {'media-type': 'application/xhtml+xml'})}
-            
-            for chapter_id in spine_ids:
-                href = html_paths_map.get(chapter_id)
-                if href:
-                    chapter_path = content_root / href
-                    if chapter_path.exists():
-                        # LA SOLUCIÓN: Pasar filename y encoding directamente a WeasyPrint
-                        html_docs.append(HTML(filename=chapter_path, encoding='utf-8'))
-
-            if not html_docs:
-                raise Exception("No se encontró contenido HTML en el EPUB.")
-
-            # 7. Renderizar y unir todos los documentos
-            first_doc = html_docs[0].render(stylesheets= stylesheets)
-            all_pages = [p for doc in html_docs[1:] for p in doc.render(stylesheets= stylesheets).pages]
-            
-            pdf_bytes_io = io.BytesIO()
-            first_doc.copy(all_pages).write_pdf(target=pdf_bytes_io)
-            pdf_bytes = pdf_bytes_io.getvalue()
-
-        # Guardar el PDF en la carpeta temporal pública
-        pdf_filename = f"{uuid.uuid4()}.pdf"
-        public_pdf_path = os.path.join(STATIC_TEMP_DIR, pdf_filename)
-        with open(public_pdf_path, "wb") as f:
-            f.write(pdf_bytes)
-        
-        # Devolver la URL de descarga en un JSON
-        return {"download_url": f"/temp_books/{pdf_filename}"}
-    except Exception as e:
-        error_message = f"Error durante la conversión: {type(e).__name__}: {e}"
-        print(error_message)
-        raise HTTPException(status_code=500, detail=error_message)
+def _start_rag_indexing(db: Session, book_id: str, file_path: str, temporary_file: bool, library_book_id: int | None,
+                        content_hash: str | None = None) -> dict:
+    job, created = rag_indexing.enqueue(db, book_id, file_path, temporary_file, library_book_id=library_book_id,
+                                        content_hash=content_hash)
+    message = "Indexación para RAG iniciada." if created else "El libro ya se estaba indexando para RAG."
+    return {"book_id": book_id, "message": message, "job": rag_indexing.describe_job(job)}
 
 @app.post("/rag/upload-book/", response_model=schemas.RagUploadResponse)
-async def upload_book_for_rag(file: UploadFile = File(...)):
-    book_id = str(uuid.uuid4())
-    file_location = os.path.join(STATIC_TEMP_DIR, f"{book_id}_{file.filename}")
-    with open(file_location, "wb") as f:
-        f.write(await file.read())
-    
+async def upload_book_for_rag(file: UploadFile = File(...), db: Session = Depends(get_db)):
+    """Sube un libro y lanza su indexación RAG como trabajo reanudable; el progreso se consulta en /rag/jobs/{id}."""
+    file_location = os.path.join(STATIC_TEMP_DIR, f"{uuid.uuid4()}_{file.filename}")
+    content_hash = await save_upload_or_413(file, file_location)
+
+    # Si el libro ya está en la biblioteca se usa su id; si no, el hash de su contenido.
+    # Así el mismo libro nunca se vuelve a indexar (ni a pagar sus embeddings).
+    library_book = crud.get_book_by_hash(db, content_hash)
+    book_id = str(library_book.id) if library_book else content_hash
+    if crud.get_rag_book(db, book_id):
+        os.remove(file_location)
+        return {"book_id": book_id, "message": "El libro ya estaba procesado para RAG."}
+    if crud.get_active_rag_index_job(db, book_id):
+        os.remove(file_location)
+        return _start_rag_indexing(db, book_id, file_location, True, None, content_hash)
+
+    # El archivo de la biblioteca sirve para indexar (y reanudar) sin conservar la copia subida
+    if library_book and os.path.exists(library_book.file_path):
+        os.remove(file_location)
+        return _start_rag_indexing(db, book_id, library_book.file_path, False, library_book.id, content_hash)
+    return _start_rag_indexing(db, book_id, file_location, True, library_book.id if library_book else None, content_hash)
+
+@app.post("/rag/index-book/{book_id}", response_model=schemas.RagUploadResponse)
+async def index_library_book_for_rag(book_id: int, db: Session = Depends(get_db)):
+    """Indexa para RAG un libro de la biblioteca leyendo su archivo en disco, sin volver a subirlo."""
+    book = crud.get_book(db, book_id)
+    if not book:
+        raise HTTPException(status_code=404, detail="Libro no encontrado.")
+    if not os.path.exists(book.file_path):
+        raise HTTPException(status_code=404, detail="Archivo no encontrado en el disco.")
+
+    rag_book_id = str(book.id)
+    if crud.get_rag_book(db, rag_book_id):
+        return {"book_id": rag_book_id, "message": "El libro ya estaba procesado para RAG."}
+    return _start_rag_indexing(db, rag_book_id, book.file_path, False, book.id, book.content_hash)
+
+@app.get("/rag/jobs/{job_id}", response_model=schemas.RagIndexJob)
+def read_rag_index_job(job_id: str, db: Session = Depends(get_db)):
+    """Progreso de una indexación RAG: fragmentos hechos/totales, ritmo y tiempo restante estimado."""
+    job = crud.get_rag_index_job(db, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado.")
+    return rag_indexing.describe_job(job)
+
+@app.post("/rag/jobs/{job_id}/resume", response_model=schemas.RagIndexJob)
+def resume_rag_index_job(job_id: str, db: Session = Depends(get_db)):
+    """Reanuda un trabajo de indexación fallido desde su último punto de control."""
+    job = crud.get_rag_index_job(db, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado.")
+    if job.status == "completed":
+        raise HTTPException(status_code=409, detail="El trabajo ya ha terminado.")
+    if job.status == "failed":
+        job = crud.update_rag_index_job(db, job_id, status="pending", detail=None)
+    rag_indexing.start_job(job.id)
+    return rag_indexing.describe_job(job)
+
+@app.get("/rag/books/", response_model=List[schemas.RagBook])
+def read_rag_books(db: Session = Depends(get_db)):
+    """Lista los libros que ya están indexados para RAG."""
+    return crud.get_rag_books(db)
+
+@app.get("/rag/embedding-cache/", response_model=schemas.EmbeddingCacheStats)
+def read_embedding_cache_stats():
+    """Muestra los aciertos de la caché de embeddings (lo que se ahorra al reindexar)."""
+    return rag.embedding_cache.get_stats()
+
+def resolve_rag_scope(query_data: schemas.RagQuery, db: Session) -> dict[str, str | None]:
+    """Traduce book_id / book_ids / category de la consulta a los libros indexados (id -> título)."""
+    selectors = [query_data.book_id, query_data.book_ids, query_data.category]
+    if sum(selector is not None for selector in selectors) != 1:
+        raise HTTPException(status_code=400, detail="Indica exactamente uno de: book_id, book_ids o category.")
+    if query_data.book_id == "all":
+        books = crud.get_rag_scope(db)
+    elif query_data.category is not None:
+        books = crud.get_rag_scope(db, category=query_data.category)
+    else:
+        books = crud.get_rag_scope(db, book_ids=query_data.book_ids or [query_data.book_id])
+    if not books:
+        raise HTTPException(status_code=404, detail="No hay libros indexados para RAG en la selección.")
+    return books
+
+@app.post("/rag/admin/compact", response_model=schemas.RagCompactionReport)
+async def compact_rag_index(rebuild: bool = True, db: Session = Depends(get_db)):
+    """
+    Elimina los vectores huérfanos (de libros que ya no están indexados ni indexándose) y, con
+    rebuild, reescribe la colección y el índice léxico para recuperar el espacio. Informa de lo liberado.
+    Mientras dura, las consultas y las indexaciones que se lancen esperan a que termine.
+    """
+    if rag_indexing.is_busy():
+        raise HTTPException(status_code=409, detail="Hay indexaciones RAG en curso; inténtalo cuando terminen.")
+    valid_book_ids = crud.get_rag_book_ids(db)
     try:
-        await rag.process_book_for_rag(file_location, book_id)
-        return {"book_id": book_id, "message": "Libro procesado para RAG exitosamente."}
+        return await rag.compact(valid_book_ids, rebuild)
     except Exception as e:
-        os.remove(file_location)
-        raise HTTPException(status_code=500, detail=f"Error al procesar el libro para RAG: {e}")
+        raise HTTPException(status_code=500, detail=f"Error al compactar el índice RAG: {e}")
 
 @app.post("/rag/query/", response_model=schemas.RagQueryResponse)
-async def query_rag_endpoint(query_data: schemas.RagQuery):
+async def query_rag_endpoint(query_data: schemas.RagQuery, db: Session = Depends(get_db)):
+    """Consulta uno o varios libros (una lista, una categoría o toda la biblioteca) y cita las fuentes."""
+    books = resolve_rag_scope(query_data, db)
     try:
-        response_text = await rag.query_rag(query_data.query, query_data.book_id)
-        return {"response": response_text}
+        return await rag.query_rag(query_data.query, list(books), query_data.mode, titles=books,
+                                   whole_library=query_data.book_id == "all")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al consultar RAG: {e}")
-    if not file.filename.lower().endswith('.epub'):
-        raise HTTPException(status_code=400, detail="El archivo debe ser un EPUB.")
 
-    epub_content = await file.read()
-
-    try:
-        import tempfile
-        import zipfile
-        import pathlib
-        from weasyprint import HTML, CSS
-        from bs4 import BeautifulSoup
-        import uuid
-
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # 1. Extraer el EPUB a una carpeta temporal
-            with zipfile.ZipFile(io.BytesIO(epub_content), 'r') as zip_ref:
-                zip_ref.extractall(temp_dir)
-
-            # 2. Encontrar el archivo .opf (el "manifiesto" del libro)
-            opf_path = next(pathlib.Path(temp_dir).rglob('*.opf'), None)
-            if not opf_path:
-                raise Exception("No se pudo encontrar el archivo .opf en el EPUB.")
-            content_root = opf_path.parent
-
-            # 3. Leer y analizar el manifiesto .opf en modo binario para autodetectar codificación
-            with open(opf_path, 'rb') as f:
-                opf_soup = BeautifulSoup(f, 'lxml-xml')
-
-            # 4. Crear una página de portada si se encuentra
-            html_docs = []
-            cover_meta = opf_soup.find('meta', {'name': 'cover'})
-            if cover_meta:
-                cover_id = cover_meta.get('content')
-                cover_item = opf_soup.find('item', {'id': cover_id})
-                if cover_item:
-                    cover_href = cover_item.get('href')
-                    cover_path = content_root / cover_href
-                    if cover_path.exists():
-                        cover_html_string = f"<html><body style='text-align: center; margin: 0; padding: 0;'><img src='{cover_path.as_uri()}' style='width: 100%; height: 100%; object-fit: contain;'/></body></html>"
-                        html_docs.append(HTML(string=cover_html_string))
-
-            # 5. Encontrar y leer todos los archivos CSS
-            stylesheets = []
-            css_items = opf_soup.find_all('item', {'media-type': 'text/css'})
-            for css_item in css_items:
-                css_href = css_item.get('href')
-                if css_href:
-                    css_path = content_root / css_href
-                    if css_path.exists():
-                        stylesheets.append(CSS(filename=css_path))
-
-            # 6. Encontrar el orden de lectura (spine) y añadir los capítulos
-            spine_ids = [item.get('idref') for item in opf_soup.find('spine').find_all('itemref')]
-            html_paths_map = {item['id']: item['href'] for item in opf_soup.find_all('item', {'media-type': 'application/xhtml+xml'})}
-            
-            for chapter_id in spine_ids:
-                href = html_paths_map.get(chapter_id)
-                if href:
-                    chapter_path = content_root / href
-                    if chapter_path.exists():
-                        # LA SOLUCIÓN: Pasar filename y encoding directamente a WeasyPrint
-                        html_docs.append(HTML(filename=chapter_path, encoding='utf-8'))
-
-            if not html_docs:
-                raise Exception("No se encontró contenido HTML en el EPUB.")
-
-            # 7. Renderizar y unir todos los documentos
-            first_doc = html_docs[0].render(stylesheets= stylesheets)
-            all_pages = [p for doc in html_docs[1:] for p in doc.render(stylesheets= stylesheets).pages]
-            
-            pdf_bytes_io = io.BytesIO()
-            first_doc.copy(all_pages).write_pdf(target=pdf_bytes_io)
-            pdf_bytes = pdf_bytes_io.getvalue()
-
-        # Guardar el PDF en la carpeta temporal pública
-        pdf_filename = f"{uuid.uuid4()}.pdf"
-        public_pdf_path = os.path.join(STATIC_TEMP_DIR, pdf_filename)
-        with open(public_pdf_path, "wb") as f:
-            f.write(pdf_bytes)
-        
-        # Devolver la URL de descarga en un JSON
-        return {"download_url": f"/temp_books/{pdf_filename}"}
-    except Exception as e:
-        error_message = f"Error durante la conversión: {type(e).__name__}: {e}"
-        print(error_message)
-        raise HTTPException(status_code=500, detail=error_message)
+@app.post("/rag/query/stream")
+async def query_rag_stream_endpoint(query_data: schemas.RagQuery, db: Session = Depends(get_db)):
+    """
+    Igual que /rag/query/, pero envía la respuesta como Server-Sent Events a medida que se
+    genera: un evento "meta" (información de caché), un evento "sources" con los fragmentos
+    citados, eventos "token" con el texto y un evento final "done" (o "error").
+    """
+    books = resolve_rag_scope(query_data, db)
+
+    async def event_stream():
+        try:
+            async for event, data in rag.stream_query_rag(query_data.query, list(books), query_data.mode, titles=books,
+                                                         whole_library=query_data.book_id == "all"):
+                yield f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+            yield "event: done\ndata: {}\n\n"
+        except Exception as e:
+            detail = json.dumps(f"Error al consultar RAG: {e}", ensure_ascii=False)
+            yield f"event: error\ndata: {detail}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
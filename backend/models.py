@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Column, Integer, String, Text, Float, Boolean, DDL, event
 from database import Base
 
 class Book(Base):
@@ -10,3 +10,72 @@ class Book(Base):
     category = Column(String, index=True)
     cover_image_url = Column(String, nullable=True)
     file_path = Column(String, unique=True) # Ruta al archivo original
+    content_hash = Column(String, unique=True, index=True, nullable=True) # SHA-256 del archivo original
+
+# Índice de texto completo FTS5 sobre título, autor y categoría, sincronizado con "books" mediante triggers.
+# La migración 4d5e6f7a8b9c crea los mismos objetos en bases de datos existentes.
+BOOKS_FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+        title, author, category,
+        content='books', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS books_fts_ai AFTER INSERT ON books BEGIN
+        INSERT INTO books_fts(rowid, title, author, category) VALUES (new.id, new.title, new.author, new.category);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS books_fts_ad AFTER DELETE ON books BEGIN
+        INSERT INTO books_fts(books_fts, rowid, title, author, category) VALUES ('delete', old.id, old.title, old.author, old.category);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS books_fts_au AFTER UPDATE ON books BEGIN
+        INSERT INTO books_fts(books_fts, rowid, title, author, category) VALUES ('delete', old.id, old.title, old.author, old.category);
+        INSERT INTO books_fts(rowid, title, author, category) VALUES (new.id, new.title, new.author, new.category);
+    END""",
+]
+for statement in BOOKS_FTS_DDL:
+    event.listen(Book.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+
+class CategoryCount(Base):
+    __tablename__ = "category_counts"
+
+    category = Column(String, primary_key=True)
+    book_count = Column(Integer, nullable=False, default=0) # Mantenido de forma incremental por crud
+
+class LibraryState(Base):
+    __tablename__ = "library_state"
+
+    id = Column(Integer, primary_key=True) # Fila única (id = 1)
+    version = Column(Integer, nullable=False, default=0) # Se incrementa con cada escritura en la biblioteca
+    updated_at = Column(Float, nullable=False, default=0.0) # Marca de tiempo Unix de la última escritura
+
+class RagBook(Base):
+    __tablename__ = "rag_books"
+
+    book_id = Column(String, primary_key=True) # Identificador del libro en la colección de vectores
+    library_book_id = Column(Integer, nullable=True, index=True) # books.id si el libro pertenece a la biblioteca
+    chunk_count = Column(Integer, nullable=False, default=0)
+    indexed_at = Column(Float, nullable=False)
+
+class RagIndexJob(Base):
+    __tablename__ = "rag_index_jobs"
+
+    id = Column(String, primary_key=True)
+    book_id = Column(String, index=True, nullable=False) # Libro que se está indexando
+    library_book_id = Column(Integer, nullable=True)
+    file_path = Column(String, nullable=False)
+    content_hash = Column(String, nullable=True) # SHA-256 del archivo, para no recalcularlo en cada ejecución
+    temporary_file = Column(Boolean, nullable=False, default=False) # Se borra el archivo al terminar
+    status = Column(String, nullable=False, default="pending") # pending, running, completed o failed
+    chunks_done = Column(Integer, nullable=False, default=0) # Punto de control: fragmentos ya guardados
+    chunks_total = Column(Integer, nullable=True)
+    detail = Column(Text, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    created_at = Column(Float, nullable=False)
+    updated_at = Column(Float, nullable=False)
+    run_started_at = Column(Float, nullable=True) # Inicio de la ejecución actual (para el ritmo y la ETA)
+    run_start_chunk = Column(Integer, nullable=False, default=0) # Fragmento desde el que se reanudó
+
+class AnalysisCache(Base):
+    __tablename__ = "analysis_cache"
+
+    key = Column(String, primary_key=True) # Hash del texto analizado y la versión del prompt
+    result = Column(Text) # Resultado del análisis serializado en JSON
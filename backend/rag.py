@@ -1,12 +1,19 @@
 import os
+import re
+import time
+import asyncio
+import contextlib
+import threading
+from typing import Callable
 import google.generativeai as genai
 from dotenv import load_dotenv
 import chromadb
-from PyPDF2 import PdfReader
-import ebooklib
-from ebooklib import epub
-from bs4 import BeautifulSoup
-import tiktoken
+from chunking import iter_chunks
+import extraction
+import embedding_cache
+import embeddings
+import answer_cache
+import lexical_index
 
 # Load environment variables
 load_dotenv()
@@ -16,107 +23,284 @@ if not API_KEY:
 genai.configure(api_key=API_KEY)
 
 # Initialize ChromaDB client
-client = chromadb.Client()
-collection = client.get_or_create_collection(name="book_rag_collection")
+CHROMA_PATH = os.getenv("RAG_CHROMA_PATH", "chroma_db")
+# On-disk client: embeddings survive restarts and the collection opens instantly
+client = chromadb.PersistentClient(path=CHROMA_PATH)
+# HNSW index parameters (only applied when the collection is created). A higher search_ef keeps
+# recall up when queries are filtered to a subset of books in a large collection.
+HNSW_METADATA = {
+    "hnsw:M": int(os.getenv("RAG_HNSW_M", 16)),
+    "hnsw:construction_ef": int(os.getenv("RAG_HNSW_CONSTRUCTION_EF", 200)),
+    "hnsw:search_ef": int(os.getenv("RAG_HNSW_SEARCH_EF", 100)),
+}
+
+# Embedding provider chosen by RAG_EMBEDDING_PROVIDER. Vectors from different models are not
+# comparable, so each non-default provider gets its own collection (books must be re-indexed).
+provider = embeddings.get_provider()
+EMBEDDING_MODEL = provider.name
+if EMBEDDING_MODEL == embeddings.GEMINI_EMBEDDING_MODEL:
+    COLLECTION_NAME = "book_rag_collection"
+else:
+    COLLECTION_NAME = "book_rag_collection_" + re.sub(r"[^a-zA-Z0-9_-]", "_", EMBEDDING_MODEL)
+COMPACTING_NAME = f"{COLLECTION_NAME}_compacting"
+REPLACED_NAME = f"{COLLECTION_NAME}_old"
+
+def _recover_interrupted_compaction():
+    """
+    Finishes or undoes a collection swap cut short by a crash (see _rebuild_collection): if the
+    live collection is missing, the previous one (or, failing that, the finished copy) takes its
+    name back; a leftover previous collection next to a live one is dropped.
+    """
+    names = {getattr(c, "name", c) for c in client.list_collections()}
+    if COLLECTION_NAME not in names:
+        for name in (REPLACED_NAME, COMPACTING_NAME):
+            if name in names:
+                print(f"Recovering the RAG collection from {name} after an interrupted compaction")
+                client.get_collection(name).modify(name=COLLECTION_NAME)
+                names.discard(name)
+                break
+    if REPLACED_NAME in names:
+        client.delete_collection(REPLACED_NAME)
+
+_recover_interrupted_compaction()
+collection = client.get_or_create_collection(name=COLLECTION_NAME, metadata=HNSW_METADATA)
+
+# Queries and indexing runs hold index_access(); a compaction waits for them to finish and makes
+# new ones wait until the rebuilt collection is in place.
+_index_gate = asyncio.Condition()
+# Held by vector deletes and for the whole of a compaction: deletes come from worker threads
+# (delete endpoints, cancelled index jobs), outside index_access(), and must not interleave with the copy
+_collection_lock = threading.RLock()
+_compacting = False
+_index_users = 0
 
-# Initialize Gemini embedding model
-EMBEDDING_MODEL = "models/text-embedding-004"
 GENERATION_MODEL = "models/gemini-1.5-flash"
+EMBEDDING_BATCH_SIZE = provider.batch_size
+EMBEDDING_CONCURRENCY = int(os.getenv("RAG_EMBEDDING_CONCURRENCY", 4))
+CHROMA_ADD_BATCH_SIZE = 1000
+COMPACTION_PAGE_SIZE = 5000
+# Chunks embedded and stored between two progress checkpoints while indexing a book
+INDEX_CHECKPOINT_CHUNKS = int(os.getenv("RAG_INDEX_CHECKPOINT_CHUNKS", EMBEDDING_BATCH_SIZE * EMBEDDING_CONCURRENCY))
+
+# Retrieval: "vector" (Chroma), "lexical" (BM25, no query embedding) or "hybrid" (both, fused by rank)
+RETRIEVAL_MODES = ("hybrid", "vector", "lexical")
+RETRIEVAL_TOP_K = int(os.getenv("RAG_TOP_K_PER_BOOK", 5)) # Chunks per book passed to the model as context
+RETRIEVAL_MAX_CHUNKS = int(os.getenv("RAG_MAX_CONTEXT_CHUNKS", 12)) # Global cap for multi-book queries
+RETRIEVAL_CANDIDATES = int(os.getenv("RAG_RETRIEVAL_CANDIDATES", 30)) # Candidates taken from each retriever
+RRF_K = 60 # Reciprocal rank fusion constant
 
 def get_embedding(text: str, task_type: str = "RETRIEVAL_DOCUMENT"):
-    """Generates an embedding for the given text."""
+    """Generates an embedding for the given text, reusing the on-disk cache when possible."""
     if not text.strip():
         return [] # Return empty list for empty text
-    return genai.embed_content(model=EMBEDDING_MODEL, content=text, task_type=task_type)["embedding"]
+    if not provider.cacheable:
+        return provider.embed([text], task_type)[0]
+    cached = embedding_cache.get_many(EMBEDDING_MODEL, task_type, [text])[0]
+    if cached is not None:
+        return cached
+    embedding = provider.embed([text], task_type)[0]
+    embedding_cache.put_many(EMBEDDING_MODEL, task_type, [text], [embedding])
+    return embedding
+
+def get_embeddings(texts: list[str], task_type: str = "RETRIEVAL_DOCUMENT") -> list[list[float]]:
+    """Generates embeddings for several texts in a single provider call."""
+    return provider.embed(texts, task_type)
+
+async def embed_in_batches(texts: list[str], task_type: str = "RETRIEVAL_DOCUMENT") -> list[list[float]]:
+    """
+    Embeds texts in batches of EMBEDDING_BATCH_SIZE, running up to EMBEDDING_CONCURRENCY
+    requests at once in worker threads so the event loop is never blocked.
+    Texts already in the embedding cache are not sent to the provider. Empty texts get an empty embedding.
+    """
+    vectors = [[] for _ in texts]
+    indexes = [i for i, text in enumerate(texts) if text.strip()]
+    missing = indexes
+    if provider.cacheable:
+        cached = await asyncio.to_thread(embedding_cache.get_many, EMBEDDING_MODEL, task_type, [texts[i] for i in indexes])
+        missing = []
+        for i, embedding in zip(indexes, cached):
+            if embedding is None:
+                missing.append(i)
+            else:
+                vectors[i] = embedding
+    semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
 
-def extract_text_from_pdf(file_path: str) -> str:
-    """Extracts text from a PDF file."""
-    text = ""
+    async def embed_batch(batch_indexes):
+        batch_texts = [texts[i] for i in batch_indexes]
+        async with semaphore:
+            batch = await asyncio.to_thread(get_embeddings, batch_texts, task_type)
+        if provider.cacheable:
+            await asyncio.to_thread(embedding_cache.put_many, EMBEDDING_MODEL, task_type, batch_texts, batch)
+        for i, embedding in zip(batch_indexes, batch):
+            vectors[i] = embedding
+
+    batches = [missing[start:start + EMBEDDING_BATCH_SIZE] for start in range(0, len(missing), EMBEDDING_BATCH_SIZE)]
+    await asyncio.gather(*(embed_batch(batch) for batch in batches))
+    if indexes and provider.cacheable:
+        print(f"Embedding cache: {len(indexes) - len(missing)}/{len(indexes)} hits")
+    return vectors
+
+def add_chunks(book_id: str, chunks: list[str], embeddings: list[list[float]], start_index: int = 0):
+    """Writes chunks and their embeddings to the collection in large bulk upsert calls."""
+    rows = [(start_index + i, chunk, embedding) for i, (chunk, embedding) in enumerate(zip(chunks, embeddings)) if embedding]
+    for start in range(0, len(rows), CHROMA_ADD_BATCH_SIZE):
+        batch = rows[start:start + CHROMA_ADD_BATCH_SIZE]
+        collection.upsert(
+            embeddings=[embedding for _, _, embedding in batch],
+            documents=[chunk for _, chunk, _ in batch],
+            metadatas=[{"book_id": book_id, "chunk_index": i} for i, _, _ in batch],
+            ids=[f"{book_id}_chunk_{i}" for i, _, _ in batch]
+        )
+
+def delete_book_index(book_id: str):
+    """Removes a book's vectors, its lexical index and its cached answers (waits for a running compaction)."""
+    with _collection_lock:
+        collection.delete(where={"book_id": book_id})
+        lexical_index.delete_book(book_id)
+    answer_cache.invalidate(book_id)
+
+def _iter_collection(include: list[str]):
+    """
+    Pages through the whole collection, COMPACTION_PAGE_SIZE entries at a time. Pages are taken by
+    sorted id rather than by offset, so every entry is visited exactly once.
+    """
+    ids = sorted(collection.get(include=[])["ids"])
+    for start in range(0, len(ids), COMPACTION_PAGE_SIZE):
+        yield collection.get(ids=ids[start:start + COMPACTION_PAGE_SIZE], include=include)
+
+def _directory_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+def _rebuild_collection() -> int:
+    """
+    Copies the live entries into a fresh collection and swaps it in. Deleted entries are only
+    marked as such in the HNSW index, so this is what actually shrinks it. Returns the entries copied.
+    The swap only renames (live -> _old, copy -> live) before dropping the old collection, so a crash
+    at any point leaves a complete collection that _recover_interrupted_compaction puts back.
+    """
+    global collection
     try:
-        with open(file_path, "rb") as f:
-            reader = PdfReader(f)
-            for page in reader.pages:
-                text += page.extract_text() or ""
-    except Exception as e:
-        print(f"Error extracting text from PDF {file_path}: {e}")
-        return ""
-    return text
-
-def extract_text_from_epub(file_path: str) -> str:
-    """Extracts text from an EPUB file."""
-    text_content = []
+        client.delete_collection(COMPACTING_NAME) # Left over from an interrupted copy; the live collection is intact
+    except Exception:
+        pass
+    rebuilt = client.create_collection(name=COMPACTING_NAME, metadata=HNSW_METADATA)
+    copied = 0
+    for page in _iter_collection(["embeddings", "documents", "metadatas"]):
+        rebuilt.add(ids=page["ids"], embeddings=page["embeddings"], documents=page["documents"], metadatas=page["metadatas"])
+        copied += len(page["ids"])
+    collection.modify(name=REPLACED_NAME)
+    rebuilt.modify(name=COLLECTION_NAME)
+    collection = client.get_collection(COLLECTION_NAME)
+    client.delete_collection(REPLACED_NAME)
+    return copied
+
+def compact_index(valid_book_ids: set[str], rebuild: bool = True) -> dict:
+    """
+    Removes the vectors and lexical entries of books that are not in valid_book_ids (orphans left by
+    deleted books) and, with rebuild, rewrites the vector collection and the lexical index to reclaim
+    their space. Returns what was removed and the bytes reclaimed on disk. Deletes requested meanwhile
+    wait and are applied to the rebuilt collection.
+    """
+    with _collection_lock:
+        return _compact_index(valid_book_ids, rebuild)
+
+def _compact_index(valid_book_ids: set[str], rebuild: bool) -> dict:
+    bytes_before = _directory_size(CHROMA_PATH) + lexical_index.size_bytes()
+    entries_before = collection.count()
+
+    orphaned_book_ids = set()
+    for page in _iter_collection(["metadatas"]):
+        orphaned_book_ids.update(m["book_id"] for m in page["metadatas"] if m["book_id"] not in valid_book_ids)
+    orphaned_book_ids.update(lexical_index.book_ids() - valid_book_ids)
+    for book_id in orphaned_book_ids:
+        delete_book_index(book_id)
+    vectors_removed = entries_before - collection.count()
+
+    if rebuild:
+        _rebuild_collection()
+        lexical_index.vacuum()
+    bytes_after = _directory_size(CHROMA_PATH) + lexical_index.size_bytes()
+    return {
+        "orphaned_books": sorted(orphaned_book_ids),
+        "vectors_removed": vectors_removed,
+        "vectors_remaining": collection.count(),
+        "bytes_before": bytes_before,
+        "bytes_after": bytes_after,
+        "bytes_reclaimed": max(bytes_before - bytes_after, 0),
+    }
+
+@contextlib.asynccontextmanager
+async def index_access():
+    """Held while reading or writing the index; waits while a compaction is rebuilding it."""
+    global _index_users
+    async with _index_gate:
+        await _index_gate.wait_for(lambda: not _compacting)
+        _index_users += 1
     try:
-        book = ebooklib.epub.read_epub(file_path)
-        for item in book.get_items():
-            if item.get_type() == ebooklib.ITEM_DOCUMENT:
-                soup = BeautifulSoup(item.get_content(), 'html.parser')
-                text_content.append(soup.get_text())
-    except Exception as e:
-        print(f"Error extracting text from EPUB {file_path}: {e}")
-        return ""
-    return "\n".join(text_content)
-
-def chunk_text(text: str, max_tokens: int = 1000) -> list[str]:
-    """Chunks text into smaller pieces based on token count."""
-    if not text.strip():
-        return []
-    tokenizer = tiktoken.encoding_for_model("gpt-3.5-turbo") # Using a common tokenizer for token counting
-    tokens = tokenizer.encode(text)
-    chunks = []
-    current_chunk_tokens = []
-    for token in tokens:
-        current_chunk_tokens.append(token)
-        if len(current_chunk_tokens) >= max_tokens:
-            chunks.append(tokenizer.decode(current_chunk_tokens))
-            current_chunk_tokens = []
-    if current_chunk_tokens:
-        chunks.append(tokenizer.decode(current_chunk_tokens))
-    return chunks
-
-async def process_book_for_rag(file_path: str, book_id: str):
-    """Extracts text, chunks it, generates embeddings, and stores in ChromaDB."""
-    if file_path.lower().endswith(".pdf"):
-        text = extract_text_from_pdf(file_path)
-    elif file_path.lower().endswith(".epub"):
-        text = extract_text_from_epub(file_path)
-    else:
-        raise ValueError("Unsupported file type. Only PDF and EPUB are supported.")
+        yield
+    finally:
+        async with _index_gate:
+            _index_users -= 1
+            _index_gate.notify_all()
 
-    if not text.strip():
+async def compact(valid_book_ids: set[str], rebuild: bool = True) -> dict:
+    """
+    Runs compact_index in a worker thread with the index to itself: waits for the queries and
+    indexing runs in progress and holds back new ones until it finishes (vector deletes are held
+    back by _collection_lock inside compact_index).
+    """
+    global _compacting
+    async with _index_gate:
+        await _index_gate.wait_for(lambda: not _compacting)
+        _compacting = True
+    try:
+        async with _index_gate:
+            await _index_gate.wait_for(lambda: _index_users == 0)
+        return await asyncio.to_thread(compact_index, valid_book_ids, rebuild)
+    finally:
+        async with _index_gate:
+            _compacting = False
+            _index_gate.notify_all()
+
+async def process_book_for_rag(file_path: str, book_id: str, start_chunk: int = 0,
+                               on_progress: Callable[[int, int], None] | None = None,
+                               content_hash: str | None = None, executor=None) -> int:
+    """
+    Loads the book's extracted text (see extraction.load_text; executor parallelizes a first
+    extraction), chunks it, generates embeddings, and stores them in ChromaDB and the lexical index.
+    Chunks are committed in batches of INDEX_CHECKPOINT_CHUNKS; after each batch on_progress(chunks_done,
+    chunks_total) is called from a worker thread so the caller can persist a checkpoint. Chunking is
+    deterministic, so passing start_chunk=chunks_done resumes an interrupted run. Returns the number of chunks.
+    """
+    if not file_path.lower().endswith((".pdf", ".epub")):
+        raise ValueError("Unsupported file type. Only PDF and EPUB are supported.")
+    pieces = await extraction.load_text(file_path, content_hash, executor)
+    if not any(piece.strip() for piece in pieces):
         raise ValueError("Could not extract text from the book.")
 
-    chunks = chunk_text(text)
+    chunks = await asyncio.to_thread(lambda: [chunk for chunk in iter_chunks(pieces) if chunk.strip()])
     if not chunks:
         raise ValueError("Could not chunk text from the book.")
 
-    for i, chunk in enumerate(chunks):
-        embedding = get_embedding(chunk) # No await here
-        if embedding: # Only add if embedding is not empty
-            collection.add(
-                embeddings=[embedding],
-                documents=[chunk],
-                metadatas=[{"book_id": book_id, "chunk_index": i}],
-                ids=[f"{book_id}_chunk_{i}"]
-            )
-    print(f"Processed {len(chunks)} chunks for book ID: {book_id}")
-
-async def query_rag(query: str, book_id: str):
-    """Queries the RAG system for answers based on the book content."""
-    query_embedding = get_embedding(query, task_type="RETRIEVAL_QUERY") # No await here
-    if not query_embedding:
-        return "I cannot process an empty query."
+    started = time.perf_counter()
+    for start in range(start_chunk, len(chunks), INDEX_CHECKPOINT_CHUNKS):
+        batch = chunks[start:start + INDEX_CHECKPOINT_CHUNKS]
+        vectors = await embed_in_batches(batch)
+        await asyncio.to_thread(add_chunks, book_id, batch, vectors, start)
+        await asyncio.to_thread(lexical_index.add_chunks, book_id, batch, start)
+        if on_progress is not None:
+            await asyncio.to_thread(on_progress, start + len(batch), len(chunks))
+    answer_cache.invalidate(book_id) # Answers about the previous index may be stale
+    elapsed = time.perf_counter() - started
+    processed = max(len(chunks) - start_chunk, 0)
+    rate = processed / elapsed if elapsed > 0 else float("inf")
+    print(f"Processed {processed} chunks for book ID: {book_id} in {elapsed:.2f}s ({rate:.1f} chunks/sec)")
+    return len(chunks)
 
-    results = collection.query(
-        query_embeddings=[query_embedding],
-        n_results=5, # Retrieve top 5 relevant chunks
-        where={"book_id": book_id}
-    )
-
-    relevant_chunks = [doc for doc in results['documents'][0]]
-    context = "\n\n".join(relevant_chunks)
-
-    prompt = f"""Eres un asistente útil que responde preguntas.
+def _build_prompt(query: str, context: str) -> str:
+    return f"""Eres un asistente útil que responde preguntas.
 Prioriza la información del Contexto proporcionado para responder a la pregunta.
+Cada fragmento del Contexto va precedido de su fuente entre corchetes; cita entre corchetes las fuentes que utilices.
 Si la información en el Contexto no es suficiente para responder la pregunta, utiliza tus conocimientos generales.
 Responde siempre en español.
 
@@ -126,6 +310,173 @@ Contexto:
 Pregunta: {query}
 Respuesta:"""
 
+async def _lookup_answer(query: str, scope: tuple[str, ...], mode: str = "hybrid") -> tuple[dict | None, list[float]]:
+    """
+    Checks the answer cache (exact match first, then by query embedding).
+    Returns (cached result or None, query embedding). In lexical mode the query is
+    never embedded, so only the exact match is tried and the embedding is empty.
+    """
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f"Unknown retrieval mode: {mode}. Use one of: {', '.join(RETRIEVAL_MODES)}.")
+    cached_answer = answer_cache.get_exact(scope, query)
+    if cached_answer is not None:
+        return {**cached_answer, "cache": {"hit": True, "match": "exact", "similarity": 1.0}}, []
+    if not query.strip():
+        return {"response": "I cannot process an empty query.", "sources": [], "cache": {"hit": False}}, []
+    if mode == "lexical":
+        return None, []
+
+    query_embedding = await asyncio.to_thread(get_embedding, query, "RETRIEVAL_QUERY")
+    if not query_embedding:
+        return {"response": "I cannot process an empty query.", "sources": [], "cache": {"hit": False}}, []
+
+    similar = await asyncio.to_thread(answer_cache.get_similar, scope, query_embedding)
+    if similar is not None:
+        answer, similarity = similar
+        return {**answer, "cache": {"hit": True, "match": "semantic", "similarity": similarity}}, query_embedding
+    return None, query_embedding
+
+def _book_filter(book_ids: list[str]) -> dict:
+    return {"book_id": book_ids[0]} if len(book_ids) == 1 else {"book_id": {"$in": book_ids}}
+
+def _vector_search(query_embedding: list[float], book_ids: list[str], n_results: int,
+                   whole_library: bool = False) -> list[tuple[str, int, str]]:
+    """
+    One nearest-neighbour query over all the books in scope, however many there are. For the whole
+    library no filter is sent (deletes and compaction keep only indexed books in the collection);
+    chunks of books still being indexed are dropped from the results.
+    """
+    results = collection.query(
+        query_embeddings=[query_embedding],
+        n_results=n_results,
+        where=None if whole_library else _book_filter(book_ids),
+        include=["documents", "metadatas"]
+    )
+    scope = set(book_ids)
+    return [
+        (metadata["book_id"], metadata["chunk_index"], doc)
+        for doc, metadata in zip(results["documents"][0], results["metadatas"][0])
+        if metadata["book_id"] in scope
+    ]
+
+def _ensure_lexical_index(book_ids: list[str]):
+    """Builds the BM25 index from the stored chunks for books indexed before it existed."""
+    for book_id in lexical_index.missing_books(book_ids):
+        stored = collection.get(where={"book_id": book_id}, include=["documents", "metadatas"])
+        chunk_indexes = [metadata["chunk_index"] for metadata in stored["metadatas"]]
+        lexical_index.add_chunks(book_id, stored["documents"], chunk_indexes=chunk_indexes)
+
+def _lexical_search(query: str, book_ids: list[str], n_results: int,
+                    whole_library: bool = False) -> list[tuple[str, int, str]]:
+    _ensure_lexical_index(book_ids)
+    if not whole_library:
+        return lexical_index.search(book_ids, query, n_results)
+    # Like the vector search, the whole library needs no scope filter; books still indexing are dropped
+    scope = set(book_ids)
+    return [row for row in lexical_index.search(None, query, n_results) if row[0] in scope]
+
+def reciprocal_rank_fusion(rankings: list[list[tuple[str, int, str]]], k: int = RRF_K) -> list[tuple[str, int, str]]:
+    """Merges ranked (book_id, chunk_index, document) lists: each chunk scores sum(1 / (k + rank))."""
+    scores: dict[tuple[str, int], float] = {}
+    documents: dict[tuple[str, int], str] = {}
+    for ranking in rankings:
+        for rank, (book_id, chunk_index, doc) in enumerate(ranking, start=1):
+            key = (book_id, chunk_index)
+            scores[key] = scores.get(key, 0.0) + 1 / (k + rank)
+            documents[key] = doc
+    return [(*key, documents[key]) for key in sorted(scores, key=scores.get, reverse=True)]
+
+def select_chunks(ranked: list[tuple[str, int, str]], top_k_per_book: int, max_chunks: int) -> list[tuple[str, int, str]]:
+    """Keeps the best chunks in rank order, at most top_k_per_book per book and max_chunks overall."""
+    per_book: dict[str, int] = {}
+    selected = []
+    for book_id, chunk_index, doc in ranked:
+        if per_book.get(book_id, 0) >= top_k_per_book:
+            continue
+        per_book[book_id] = per_book.get(book_id, 0) + 1
+        selected.append((book_id, chunk_index, doc))
+        if len(selected) >= max_chunks:
+            break
+    return selected
+
+async def _retrieve_context(query: str, query_embedding: list[float], book_ids: list[str], mode: str = "hybrid",
+                            titles: dict[str, str | None] | None = None, whole_library: bool = False) -> tuple[str, list[dict]]:
+    """
+    Retrieves the context for a query over one or more books (whole_library: book_ids are every indexed book).
+    Returns (context text with a source label per chunk, list of sources).
+    """
+    titles = titles or {}
+    max_chunks = min(RETRIEVAL_MAX_CHUNKS, RETRIEVAL_TOP_K * len(book_ids))
+    async with index_access():
+        if mode == "vector":
+            ranked = await asyncio.to_thread(_vector_search, query_embedding, book_ids, RETRIEVAL_CANDIDATES, whole_library)
+        elif mode == "lexical":
+            ranked = await asyncio.to_thread(_lexical_search, query, book_ids, RETRIEVAL_CANDIDATES, whole_library)
+        else:
+            vector_ranked, lexical_ranked = await asyncio.gather(
+                asyncio.to_thread(_vector_search, query_embedding, book_ids, RETRIEVAL_CANDIDATES, whole_library),
+                asyncio.to_thread(_lexical_search, query, book_ids, RETRIEVAL_CANDIDATES, whole_library),
+            )
+            ranked = reciprocal_rank_fusion([vector_ranked, lexical_ranked])
+    selected = select_chunks(ranked, RETRIEVAL_TOP_K, max_chunks)
+
+    sources = [
+        {"book_id": book_id, "title": titles.get(book_id), "chunk_index": chunk_index}
+        for book_id, chunk_index, _ in selected
+    ]
+    context = "\n\n".join(
+        f"[{titles.get(book_id) or book_id}, fragmento {chunk_index}]\n{doc}" for book_id, chunk_index, doc in selected
+    )
+    return context, sources
+
+async def query_rag(query: str, book_ids: list[str], mode: str = "hybrid", titles: dict[str, str | None] | None = None,
+                    whole_library: bool = False) -> dict:
+    """
+    Queries the RAG system for answers based on the content of one or more books.
+    Returns {"response": ..., "sources": [...], "cache": {...}}; repeated (or, above the similarity
+    threshold, near-identical) questions are answered from the answer cache without a generation call.
+    mode selects the retrieval: "hybrid" (default), "vector" or "lexical". titles labels the sources.
+    whole_library says that book_ids are all the indexed books, so the vector search needs no filter.
+    """
+    scope = tuple(sorted(book_ids))
+    cached, query_embedding = await _lookup_answer(query, scope, mode)
+    if cached is not None:
+        return cached
+
+    context, sources = await _retrieve_context(query, query_embedding, book_ids, mode, titles, whole_library)
+    model = genai.GenerativeModel(GENERATION_MODEL)
+    response = await model.generate_content_async(_build_prompt(query, context))
+    answer = {"response": response.text, "sources": sources}
+    answer_cache.put(scope, query, query_embedding, answer)
+    return {**answer, "cache": {"hit": False}}
+
+async def stream_query_rag(query: str, book_ids: list[str], mode: str = "hybrid", titles: dict[str, str | None] | None = None,
+                           whole_library: bool = False):
+    """
+    Streaming variant of query_rag. Yields (event, data) pairs: one "meta" event with the
+    cache information, one "sources" event, then "token" events with text as the model generates it.
+    """
+    scope = tuple(sorted(book_ids))
+    cached, query_embedding = await _lookup_answer(query, scope, mode)
+    if cached is not None:
+        yield "meta", cached["cache"]
+        yield "sources", cached["sources"]
+        yield "token", cached["response"]
+        return
+
+    yield "meta", {"hit": False}
+    context, sources = await _retrieve_context(query, query_embedding, book_ids, mode, titles, whole_library)
+    yield "sources", sources
     model = genai.GenerativeModel(GENERATION_MODEL)
-    response = model.generate_content(prompt) # No await here
-    return response.text
\ No newline at end of file
+    response = await model.generate_content_async(_build_prompt(query, context), stream=True)
+    parts = []
+    async for chunk in response:
+        try:
+            text = chunk.text
+        except ValueError: # Chunk without text parts (e.g. only finish/safety information)
+            continue
+        parts.append(text)
+        yield "token", text
+    response_text = "".join(parts)
+    if response_text.strip(): # A blocked (empty) answer is not cached, as in query_rag
+        answer_cache.put(scope, query, query_embedding, {"response": response_text, "sources": sources})
@@ -0,0 +1,150 @@
+import asyncio
+import os
+import time
+import uuid
+
+import crud, database, extraction, ingest, jobs
+import rag
+
+# --- Trabajos de indexación RAG persistentes y reanudables ---
+# El estado vive en la tabla rag_index_jobs: tras cada lote de fragmentos guardado se anota
+# chunks_done, de modo que un fallo o un reinicio retoma la indexación desde ese punto.
+RAG_INDEX_RETRIES = int(os.getenv("RAG_INDEX_RETRIES", 3)) # Reintentos automáticos ante errores transitorios
+RAG_INDEX_RETRY_DELAY = 5.0 # Segundos, multiplicados por el número de intento
+
+# Trabajos que se están ejecutando en este proceso, para no lanzar el mismo dos veces
+_running: set[str] = set()
+
+def _update_job(job_id: str, **fields):
+    db = database.SessionLocal()
+    try:
+        crud.update_rag_index_job(db, job_id, **fields)
+    finally:
+        db.close()
+
+def _load_job(job_id: str):
+    db = database.SessionLocal()
+    try:
+        return crud.get_rag_index_job(db, job_id)
+    finally:
+        db.close()
+
+def _finish_job(job_id: str, book_id: str, chunks_total: int, library_book_id: int | None) -> bool:
+    """Registra el libro como indexado. Devuelve False si el trabajo desapareció (el libro se borró mientras tanto)."""
+    db = database.SessionLocal()
+    try:
+        if crud.get_rag_index_job(db, job_id) is None:
+            return False
+        crud.save_rag_book(db, book_id, chunks_total, library_book_id=library_book_id)
+        crud.update_rag_index_job(db, job_id, status="completed", chunks_done=chunks_total, chunks_total=chunks_total)
+        return True
+    finally:
+        db.close()
+
+def describe_job(job) -> dict:
+    """Estado de un trabajo con su progreso, ritmo (fragmentos/s de la ejecución actual) y tiempo restante estimado."""
+    progress = job.chunks_done / job.chunks_total if job.chunks_total else 0.0
+    rate = None
+    eta = None
+    if job.status == "running" and job.run_started_at and job.updated_at > job.run_started_at:
+        done_this_run = job.chunks_done - job.run_start_chunk
+        if done_this_run > 0:
+            rate = done_this_run / (job.updated_at - job.run_started_at)
+            if job.chunks_total:
+                eta = (job.chunks_total - job.chunks_done) / rate
+    return {
+        "id": job.id,
+        "book_id": job.book_id,
+        "status": job.status,
+        "chunks_done": job.chunks_done,
+        "chunks_total": job.chunks_total,
+        "progress": 1.0 if job.status == "completed" else progress,
+        "chunks_per_second": rate,
+        "eta_seconds": eta,
+        "attempts": job.attempts,
+        "detail": job.detail,
+        "created_at": job.created_at,
+        "updated_at": job.updated_at,
+    }
+
+def _is_permanent(error: Exception) -> bool:
+    """Los errores de contenido (formato no soportado, libro sin texto) no se arreglan reintentando."""
+    return isinstance(error, ValueError)
+
+async def run_rag_index_job(job_id: str):
+    """Indexa (o sigue indexando) el libro de un trabajo, guardando un punto de control por lote."""
+    _running.add(job_id)
+    try:
+        attempt = 0
+        while True:
+            job = _load_job(job_id)
+            if job is None or job.status == "completed":
+                return
+            attempt += 1
+            _update_job(job_id, status="running", detail=None, attempts=job.attempts + 1,
+                        run_started_at=time.time(), run_start_chunk=job.chunks_done)
+            try:
+                # El hash se calcula una sola vez y se guarda en el trabajo para los reintentos y reanudaciones
+                content_hash = job.content_hash
+                if content_hash is None:
+                    content_hash = await asyncio.to_thread(extraction.file_hash, job.file_path)
+                    _update_job(job_id, content_hash=content_hash)
+                # Espera si hay una compactación reconstruyendo el índice
+                async with rag.index_access():
+                    chunks_total = await rag.process_book_for_rag(
+                        job.file_path, job.book_id, start_chunk=job.chunks_done,
+                        on_progress=lambda done, total: _update_job(job_id, chunks_done=done, chunks_total=total),
+                        content_hash=content_hash, executor=ingest.get_executor()
+                    )
+            except Exception as e:
+                if _is_permanent(e) or attempt > RAG_INDEX_RETRIES:
+                    _update_job(job_id, status="failed", detail=str(e))
+                    return
+                print(f"Error al indexar {job.book_id} (intento {attempt}), se reanuda desde el punto de control: {e}")
+                await asyncio.sleep(RAG_INDEX_RETRY_DELAY * attempt)
+                continue
+            if not await asyncio.to_thread(_finish_job, job_id, job.book_id, chunks_total, job.library_book_id):
+                await asyncio.to_thread(rag.delete_book_index, job.book_id)
+            if job.temporary_file and os.path.exists(job.file_path):
+                os.remove(job.file_path)
+            return
+    finally:
+        _running.discard(job_id)
+
+def is_busy() -> bool:
+    """Indica si hay indexaciones en curso en este proceso."""
+    return bool(_running)
+
+def start_job(job_id: str):
+    """Lanza un trabajo en segundo plano salvo que ya se esté ejecutando en este proceso."""
+    if job_id not in _running:
+        _running.add(job_id)
+        jobs.run_in_background(run_rag_index_job(job_id))
+
+def enqueue(db, book_id: str, file_path: str, temporary_file: bool, library_book_id: int | None = None,
+            content_hash: str | None = None):
+    """
+    Crea el trabajo de indexación de un libro y lo lanza. Si el libro ya tiene un trabajo sin
+    terminar, lo reutiliza (reanudándolo si había fallado) y devuelve (trabajo, False).
+    """
+    job = crud.get_active_rag_index_job(db, book_id)
+    if job is not None:
+        if job.status == "failed":
+            job = crud.update_rag_index_job(db, job.id, status="pending", detail=None)
+        start_job(job.id)
+        return job, False
+    job = crud.create_rag_index_job(db, str(uuid.uuid4()), book_id, file_path, temporary_file,
+                                    library_book_id=library_book_id, content_hash=content_hash)
+    start_job(job.id)
+    return job, True
+
+def resume_unfinished_jobs():
+    """Relanza al arrancar los trabajos que quedaron pendientes o a medias."""
+    db = database.SessionLocal()
+    try:
+        unfinished = crud.get_unfinished_rag_index_jobs(db)
+    finally:
+        db.close()
+    for job in unfinished:
+        print(f"Reanudando la indexación RAG de {job.book_id} desde el fragmento {job.chunks_done}")
+        start_job(job.id)
@@ -1,3 +1,5 @@
+from typing import Literal
+
 from pydantic import BaseModel
 
 class BookBase(BaseModel):
@@ -6,6 +8,7 @@ class BookBase(BaseModel):
     category: str
     cover_image_url: str | None = None
     file_path: str
+    content_hash: str | None = None
 
 class Book(BookBase):
     id: int
@@ -13,16 +16,113 @@ class Book(BookBase):
     class Config:
         from_attributes = True
 
-class ConversionResponse(BaseModel):
-    download_url: str
+class BookFields(BaseModel):
+    """Libro con proyección de campos: solo se serializan los campos solicitados."""
+    id: int
+    title: str | None = None
+    author: str | None = None
+    category: str | None = None
+    cover_image_url: str | None = None
+    file_path: str | None = None
+    content_hash: str | None = None
+
+class BookPage(BaseModel):
+    items: list[BookFields]
+    next_cursor: str | None = None
+
+class CategoryCount(BaseModel):
+    category: str
+    book_count: int
+
+    class Config:
+        from_attributes = True
+
+class BulkUploadResult(BaseModel):
+    filename: str
+    status: str
+    detail: str | None = None
+    book: Book | None = None
+
+class BulkUploadResponse(BaseModel):
+    results: list[BulkUploadResult]
+    total: int
+    created: int
+    failed: int
+    elapsed_seconds: float
+    books_per_second: float
+
+class Job(BaseModel):
+    id: str
+    kind: str
+    status: str
+    stage: str
+    progress: float
+    detail: str | None = None
+    result: dict | None = None
+    created_at: float
+    updated_at: float
+
+class RagIndexJob(BaseModel):
+    id: str
+    book_id: str
+    status: str # pending, running, completed o failed
+    chunks_done: int
+    chunks_total: int | None = None
+    progress: float
+    chunks_per_second: float | None = None
+    eta_seconds: float | None = None
+    attempts: int
+    detail: str | None = None
+    created_at: float
+    updated_at: float
 
 class RagUploadResponse(BaseModel):
     book_id: str
     message: str
+    job: RagIndexJob | None = None # Trabajo de indexación en curso, si el libro no estaba indexado
+
+class RagBook(BaseModel):
+    book_id: str
+    library_book_id: int | None = None
+    chunk_count: int
+    indexed_at: float
+
+    class Config:
+        from_attributes = True
+
+class EmbeddingCacheStats(BaseModel):
+    hits: int
+    misses: int
+    hit_rate: float
+    entries: int
+
+class RagCompactionReport(BaseModel):
+    orphaned_books: list[str]
+    vectors_removed: int
+    vectors_remaining: int
+    bytes_before: int
+    bytes_after: int
+    bytes_reclaimed: int
 
 class RagQuery(BaseModel):
+    """Se indica uno de: book_id (un libro, o "all" para todos los indexados), book_ids o category."""
     query: str
+    book_id: str | None = None
+    book_ids: list[str] | None = None
+    category: str | None = None
+    mode: Literal["hybrid", "vector", "lexical"] = "hybrid" # "lexical" no calcula el embedding de la pregunta
+
+class RagCacheInfo(BaseModel):
+    hit: bool
+    match: str | None = None # "exact" o "semantic"
+    similarity: float | None = None
+
+class RagSource(BaseModel):
     book_id: str
+    title: str | None = None
+    chunk_index: int
 
 class RagQueryResponse(BaseModel):
-    response: str
\ No newline at end of file
+    response: str
+    sources: list[RagSource] = []
+    cache: RagCacheInfo | None = None
\ No newline at end of file
@@ -0,0 +1,51 @@
+"""
+Mide el rendimiento del proveedor de embeddings local (embeddings.HashingEmbeddingProvider)
+sobre los fragmentos que produce el troceador del RAG, sin llamar a ningún servicio remoto.
+
+Uso:
+    python backend/scripts/benchmark_embeddings.py [archivo.txt] [--dimensions D] [--batch N] [--repeat N]
+
+Sin archivo, se genera un texto sintético de unas 300.000 palabras.
+"""
+import argparse
+import pathlib
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+from chunking import chunk_text  # noqa: E402
+from embeddings import HashingEmbeddingProvider  # noqa: E402
+
+
+def synthetic_text(words: int = 300_000) -> str:
+    sentence = "El bibliotecario ordenó los volúmenes antiguos en la estantería del fondo. "
+    paragraph = sentence * 12 + "\n\n"
+    repeats = words // len(paragraph.split()) + 1
+    return paragraph * repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file", nargs="?", help="Archivo de texto a indexar")
+    parser.add_argument("--dimensions", type=int, default=768)
+    parser.add_argument("--batch", type=int, default=HashingEmbeddingProvider.batch_size)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    text = pathlib.Path(args.file).read_text(encoding="utf-8") if args.file else synthetic_text()
+    chunks = chunk_text(text)
+    provider = HashingEmbeddingProvider(args.dimensions)
+    print(f"Texto: {len(text):,} caracteres, {len(chunks)} fragmentos, proveedor {provider.name}\n")
+
+    best = float("inf")
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        for start in range(0, len(chunks), args.batch):
+            provider.embed(chunks[start:start + args.batch])
+        best = min(best, time.perf_counter() - started)
+    print(f"{'embed (por lotes de ' + str(args.batch) + ')':<28} {best * 1000:9.1f} ms  "
+          f"{len(chunks) / best:10.1f} fragmentos/s")
+
+
+if __name__ == "__main__":
+    main()
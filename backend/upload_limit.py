@@ -0,0 +1,73 @@
+import json
+
+# --- Límite de tamaño de las subidas ---
+# Starlette vuelca el cuerpo multipart entero a un archivo temporal antes de llamar al endpoint,
+# así que el límite se aplica aquí, sobre los bytes según llegan: se rechaza de entrada si
+# Content-Length ya lo supera y, si no lo trae (o miente), en cuanto se recibe un byte de más.
+MULTIPART_OVERHEAD = 1024 * 1024 # Margen para las cabeceras y separadores del multipart
+
+class BodyTooLarge(Exception):
+    pass
+
+class UploadSizeLimitMiddleware:
+    """Middleware ASGI que responde 413 cuando el cuerpo de una ruta supera su límite (limits: ruta -> bytes)."""
+
+    def __init__(self, app, limits: dict[str, int]):
+        self.app = app
+        self.limits = limits
+
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get(scope.get("path")) if scope["type"] == "http" else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        try:
+            content_length = int(headers.get(b"content-length", b"0"))
+        except ValueError:
+            content_length = 0
+        if content_length > limit:
+            await _send_413(send, limit)
+            return
+
+        received = 0
+        exceeded = False
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    exceeded = True
+                    raise BodyTooLarge()
+            return message
+
+        async def guarded_send(message):
+            nonlocal response_started
+            # El endpoint convierte el error de lectura en otra respuesta: se sustituye por el 413
+            if exceeded:
+                if not response_started:
+                    response_started = True
+                    await _send_413(send, limit)
+                return
+            response_started = response_started or message["type"] == "http.response.start"
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except BodyTooLarge:
+            if not response_started:
+                await _send_413(send, limit)
+
+async def _send_413(send, limit: int):
+    detail = f"El archivo supera el tamaño máximo permitido ({(limit - MULTIPART_OVERHEAD) // (1024 * 1024)} MB)."
+    body = json.dumps({"detail": detail}, ensure_ascii=False).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": 413,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()), (b"connection", b"close")],
+    })
+    await send({"type": "http.response.body", "body": body})
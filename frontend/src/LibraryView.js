@@ -34,6 +34,9 @@ const BookCover = ({ src, alt, title }) => {
   return <img src={src} alt={alt} className="book-cover" onError={handleError} />;
 };
 
+const BOOKS_PAGE_SIZE = 60;
+const GRID_FIELDS = 'id,title,author,category,cover_image_url,file_path';
+
 function LibraryView() {
   const [books, setBooks] = useState([]);
   const [searchParams, setSearchParams] = useSearchParams();
@@ -41,6 +44,7 @@ function LibraryView() {
   const debouncedSearchTerm = useDebounce(searchTerm, 300);
   const [error, setError] = useState('');
   const [loading, setLoading] = useState(true);
+  const [nextCursor, setNextCursor] = useState(null);
   const [isMobile, setIsMobile] = useState(false); // New state for mobile detection
 
   // Effect to detect mobile
@@ -63,11 +67,15 @@ function LibraryView() {
     setSearchParams({ category: category });
   };
 
-  const fetchBooks = useCallback(async () => {
+  const fetchBooks = useCallback(async (cursor = null) => {
     setLoading(true);
     setError('');
 
-    const params = new URLSearchParams();
+    // Solo los campos que usa la cuadrícula, una página cada vez
+    const params = new URLSearchParams({ limit: BOOKS_PAGE_SIZE, fields: GRID_FIELDS });
+    if (cursor) {
+      params.append('cursor', cursor);
+    }
     const category = searchParams.get('category');
     const author = searchParams.get('author'); // Get the new 'author' parameter
 
@@ -86,7 +94,8 @@ function LibraryView() {
       const response = await fetch(url);
       if (response.ok) {
         const data = await response.json();
-        setBooks(data);
+        setBooks(prevBooks => (cursor ? [...prevBooks, ...data.items] : data.items));
+        setNextCursor(data.next_cursor);
       } else {
         setError('No se pudieron cargar los libros.');
       }
@@ -187,6 +196,12 @@ function LibraryView() {
           </div>
         ))}
       </div>
+
+      {!loading && nextCursor && (
+        <button onClick={() => fetchBooks(nextCursor)} className="download-button">
+          Cargar más
+        </button>
+      )}
     </div>
   );
 }
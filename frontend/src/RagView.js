@@ -30,6 +30,22 @@ function RagView() {
     event.stopPropagation();
   };
 
+  const waitForIndexJob = async (jobId) => {
+    // Consulta el trabajo de indexación hasta que termine, mostrando el progreso
+    while (true) {
+      const response = await fetch(`${API_URL}/rag/jobs/${jobId}`);
+      const job = await response.json();
+      if (!response.ok || job.status === 'completed' || job.status === 'failed') {
+        return job;
+      }
+      if (job.chunks_total) {
+        const eta = job.eta_seconds != null ? `, quedan ~${Math.ceil(job.eta_seconds)} s` : '';
+        setMessage(`Indexando libro para RAG: ${job.chunks_done}/${job.chunks_total} fragmentos${eta}.`);
+      }
+      await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+  };
+
   const handleUpload = async () => {
     if (!selectedFile) {
       setMessage('Por favor, selecciona un archivo PDF o EPUB primero.');
@@ -49,6 +65,11 @@ function RagView() {
 
       if (response.ok) {
         const result = await response.json();
+        const job = result.job ? await waitForIndexJob(result.job.id) : null;
+        if (job && job.status !== 'completed') {
+          setMessage(`Error: ${job.detail || 'No se pudo procesar el libro para RAG.'}`);
+          return;
+        }
         setBookId(result.book_id);
         setMessage('Libro procesado exitosamente. ¡Ahora puedes hacer preguntas!');
         setChatHistory([]); // Clear chat history for new book
@@ -76,7 +97,7 @@ function RagView() {
     setIsLoading(true);
 
     try {
-      const response = await fetch(`${API_URL}/rag/query/`, {
+      const response = await fetch(`${API_URL}/rag/query/stream`, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -84,12 +105,33 @@ function RagView() {
         body: JSON.stringify({ query: currentQuery, book_id: bookId }),
       });
 
-      if (response.ok) {
-        const result = await response.json();
-        setChatHistory([...newChatHistory, { sender: 'gemini', text: result.response }]);
-      } else {
+      if (!response.ok) {
         const result = await response.json();
         setChatHistory([...newChatHistory, { sender: 'gemini', text: `Error: ${result.detail || 'No se pudo obtener respuesta.'}` }]);
+        return;
+      }
+
+      // Leer los eventos SSE a medida que llegan y ir completando la respuesta
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      let answer = '';
+      for (;;) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+        for (const rawEvent of events) {
+          const eventName = rawEvent.match(/^event: (.*)$/m)?.[1];
+          const data = JSON.parse(rawEvent.match(/^data: (.*)$/m)?.[1] ?? 'null');
+          if (eventName === 'token') {
+            answer += data;
+          } else if (eventName === 'error') {
+            answer = `Error: ${data}`;
+          }
+          setChatHistory([...newChatHistory, { sender: 'gemini', text: answer }]);
+        }
       }
     } catch (error) {
       setChatHistory([...newChatHistory, { sender: 'gemini', text: 'Error de conexión al consultar.' }]);
@@ -27,6 +27,18 @@ function EpubToPdfConverter() {
     event.stopPropagation();
   };
 
+  const waitForJob = async (jobId) => {
+    // Consulta el estado del trabajo de conversión hasta que termine
+    while (true) {
+      const response = await fetch(`${API_URL}/jobs/${jobId}`);
+      const job = await response.json();
+      if (!response.ok || job.status === 'completed' || job.status === 'failed') {
+        return job;
+      }
+      await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+  };
+
   const handleConvert = async () => {
     if (!selectedFile) {
       setMessage('Por favor, selecciona un archivo EPUB primero.');
@@ -49,9 +61,13 @@ function EpubToPdfConverter() {
       });
 
       if (response.ok) {
-        // El backend ahora devuelve un JSON con la URL de descarga
-        const result = await response.json();
-        const downloadUrl = `${API_URL}${result.download_url}`;
+        // El backend devuelve un trabajo; su resultado contiene la URL de descarga
+        const job = await waitForJob((await response.json()).id);
+        if (job.status !== 'completed') {
+          setMessage(`Error: ${job.detail || 'No se pudo procesar el archivo.'}`);
+          return;
+        }
+        const downloadUrl = `${API_URL}${job.result.download_url}`;
         
         // Crear un enlace y hacer clic para iniciar la descarga
         const a = document.createElement('a');
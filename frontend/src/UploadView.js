@@ -46,6 +46,18 @@ function UploadView() {
     });
   };
 
+  const waitForJob = async (jobId) => {
+    // Consulta el estado del trabajo de ingesta hasta que termine
+    while (true) {
+      const response = await fetch(`${API_URL}/jobs/${jobId}`);
+      const job = await response.json();
+      if (!response.ok || job.status === 'completed' || job.status === 'failed') {
+        return job;
+      }
+      await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+  };
+
   const handleUpload = async () => {
     if (filesToUpload.length === 0) return;
 
@@ -64,10 +76,16 @@ function UploadView() {
           body: formData,
         });
         const result = await response.json();
-        if (response.ok) {
-          updateFileStatus(i, 'success', `'${result.title}' añadido correctamente.`);
-        } else {
+        if (!response.ok) {
           updateFileStatus(i, 'error', `Error: ${result.detail || 'No se pudo procesar'}`);
+          continue;
+        }
+        updateFileStatus(i, 'uploading', 'Analizando...');
+        const job = await waitForJob(result.id);
+        if (job.status === 'completed') {
+          updateFileStatus(i, 'success', `'${job.result.title}' añadido correctamente.`);
+        } else {
+          updateFileStatus(i, 'error', `Error: ${job.detail || 'No se pudo procesar'}`);
         }
       } catch (error) {
         updateFileStatus(i, 'error', 'Error de conexión con el servidor.');